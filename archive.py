@@ -0,0 +1,116 @@
+## persistent index of finished downloads
+import os
+import time
+import sqlite3
+import threading
+
+
+class DownloadIndex:
+    """ SQLite index of completed downloads keyed by extractor + video id.
+    One row per (extractor, video_id, profile, directory), so the same video
+    saved as audio and as video, or into two playlists, is tracked separately.
+    The rows of one video and profile are also the content store: a file
+    saved into one directory is linked into the others by find() """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS downloads (
+                    extractor TEXT NOT NULL,
+                    video_id  TEXT NOT NULL,
+                    profile   TEXT NOT NULL,
+                    directory TEXT NOT NULL,
+                    path      TEXT NOT NULL,
+                    format    TEXT,
+                    size      INTEGER,
+                    completed REAL,
+                    title     TEXT,
+                    PRIMARY KEY (extractor, video_id, profile, directory)
+                )
+            """)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(downloads)")]
+            if "title" not in columns:
+                # databases from before the content store
+                self.conn.execute("ALTER TABLE downloads ADD COLUMN title TEXT")
+
+    def get(self, extractor: str, video_id: str, profile: str, directory: str) -> dict | None:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, format, size, completed FROM downloads "
+                "WHERE extractor=? AND video_id=? AND profile=? AND directory=?",
+                (extractor, video_id, profile, os.path.abspath(directory)),
+            ).fetchone()
+        if row is None:
+            return None
+        return {'path': row[0], 'format': row[1], 'size': row[2], 'completed': row[3]}
+
+    def is_downloaded(self, extractor: str, video_id: str, profile: str, directory: str) -> bool:
+        """ True only if the recorded file is still on disk """
+        record = self.get(extractor, video_id, profile, directory)
+        return record is not None and os.path.isfile(record['path'])
+
+    def find(self, extractor: str, video_id: str, profile: str) -> dict | None:
+        """ Newest record of the video and profile in any directory whose
+        file is still on disk """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path, format, size, completed, title FROM downloads "
+                "WHERE extractor=? AND video_id=? AND profile=? ORDER BY completed DESC",
+                (extractor, video_id, profile),
+            ).fetchall()
+        for row in rows:
+            if os.path.isfile(row[0]):
+                return {'path': row[0], 'format': row[1], 'size': row[2], 'completed': row[3], 'title': row[4]}
+        return None
+
+    def store_stats(self) -> dict:
+        """ Number and size of distinct files, links of one file count once """
+        with self.lock:
+            files, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ("
+                "SELECT MAX(size) AS size FROM downloads GROUP BY extractor, video_id, profile)"
+            ).fetchone()
+        return {'files': files, 'bytes': size}
+
+    def add(
+        self,
+        extractor: str,
+        video_id: str,
+        profile: str,
+        path: str,
+        fmt: str = None,
+        title: str = None,
+    ) -> None:
+        path = os.path.abspath(path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO downloads "
+                "(extractor, video_id, profile, directory, path, format, size, completed, title) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (extractor, video_id, profile, os.path.dirname(path), path, fmt, size, time.time(), title),
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+_indexes: dict[str, DownloadIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(path: str) -> DownloadIndex:
+    """ Shared index instance per database file """
+    path = os.path.abspath(path)
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = DownloadIndex(path)
+        return _indexes[path]
@@ -1,17 +1,20 @@
 ## cli auto updater
 import os
 import cfg
+import net
 import time
 import zipfile
-import requests as rq
-from main import version_check
+import importlib
+
+version_check = importlib.import_module("yt-playlist-downloader").version_check
 
 
 zip_path = "./update.zip"
 
 
 def main():
-    need_update, current, latest = version_check()
+    # the updater always asks for the latest version
+    need_update, current, latest = version_check(use_cache=False)
     print()
     if not need_update:
         print("[WARNING] Program is up to date, no update needed")
@@ -24,26 +27,26 @@ def main():
     url = f"{cfg.GIT_LINK.strip('/')}/archive/refs/heads/main.zip"
     try:
         print("[UPDATER] Downloading update...")
-        resp = rq.get(url, stream=True, allow_redirects=True)
-        resp.raise_for_status()
-        total = int(resp.headers.get('content-length', 0))
+        with net.get(url, stream=True, allow_redirects=True) as resp:
+            resp.raise_for_status()
+            total = int(resp.headers.get('content-length', 0))
 
-        with open(zip_path, "wb") as f:
-            downloaded = 0
-            for chunk in resp.iter_content(chunk_size=1024*16):
-                if chunk:
-                    downloaded += len(chunk)
-                    print(
-                        f"\r[UPDATER] Downloading {downloaded}",
-                        end="",
-                    )
-                    if total > 0:
+            with open(zip_path, "wb") as f:
+                downloaded = 0
+                for chunk in resp.iter_content(chunk_size=1024*16):
+                    if chunk:
+                        downloaded += len(chunk)
                         print(
-                            f"/{total} ({int(downloaded/total*100)}%)",
+                            f"\r[UPDATER] Downloading {downloaded}",
                             end="",
-                            flush=True,
                         )
-                    f.write(chunk)
+                        if total > 0:
+                            print(
+                                f"/{total} ({int(downloaded/total*100)}%)",
+                                end="",
+                                flush=True,
+                            )
+                        f.write(chunk)
         print()
         print("[UPDATER] Download complete")
         
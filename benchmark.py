@@ -0,0 +1,310 @@
+## offline benchmarks of the download orchestration
+##
+## A local http server stands in for the media hosts and FakeYoutubeDL
+## replaces yt_dlp.YoutubeDL, so throughput and scheduling overhead can be
+## measured without touching youtube. ffmpeg is replaced by a file copy.
+##
+## python benchmark.py [--sizes 50,200] [--workers 1,4,8,16] [--media-kb 256]
+##                     [--latency-ms 20] [--extract-ms 30] [--output FILE]
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import logging
+import platform
+import tempfile
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import main
+import yt_dlp
+
+
+CHUNK = os.urandom(64 * 1024)
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """ /media/<id>?size=<bytes> returns synthetic bytes after latency_ms """
+    protocol_version = "HTTP/1.1"
+    latency_ms = 0
+
+    def do_GET(self):
+        time.sleep(self.latency_ms / 1000)
+        size = int(self.path.rsplit("size=", 1)[-1]) if "size=" in self.path else len(CHUNK)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        left = size
+        while left > 0:
+            self.wfile.write(CHUNK[:min(left, len(CHUNK))])
+            left -= len(CHUNK)
+
+    def log_message(self, *args):
+        pass
+
+
+class MediaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections from many workers at once
+    request_queue_size = 256
+
+
+def start_server(latency_ms: int) -> ThreadingHTTPServer:
+    MediaHandler.latency_ms = latency_ms
+    server = MediaServer(("127.0.0.1", 0), MediaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeYoutubeDL:
+    """ Subset of yt_dlp.YoutubeDL used by main, backed by the local server """
+    server_url = ""
+    media_size = 256 * 1024
+    extract_ms = 0
+    playlist_size = 0
+
+    def __init__(self, params: dict = None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    @staticmethod
+    def sanitize_info(info: dict, remove_private_keys: bool = False) -> dict:
+        return info
+
+    def extract_info(self, url: str, download: bool = True, process: bool = True, ie_key: str = None) -> dict:
+        time.sleep(self.extract_ms / 1000)
+        if "/playlist" in url:
+            return {
+                '_type': 'playlist',
+                'title': "Benchmark playlist",
+                'playlist_count': self.playlist_size,
+                'entries': (
+                    {
+                        '_type': 'url',
+                        'ie_key': 'Youtube',
+                        'id': f"bench{i:06d}",
+                        'url': f"https://www.youtube.com/watch?v=bench{i:06d}",
+                        'duration': 180,
+                    }
+                    for i in range(self.playlist_size)
+                ),
+            }
+        video_id = url.rsplit("=", 1)[-1]
+        return {
+            '_type': 'video',
+            'id': video_id,
+            'extractor_key': 'Youtube',
+            'title': f"Track {video_id}",
+            'ext': 'mp4',
+            'format_id': '18',
+            'duration': 180,
+            'filesize_approx': self.media_size,
+            'url': f"{self.server_url}/media/{video_id}?size={self.media_size}",
+            'webpage_url': url,
+        }
+
+    def process_ie_result(self, info: dict, download: bool = True) -> dict:
+        outtmpl = self.params['outtmpl']
+        if isinstance(outtmpl, dict):
+            outtmpl = outtmpl['default']
+        path = outtmpl.replace("%(title)s", info['title']).replace("%(ext)s", info['ext'])
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        hooks = self.params.get('progress_hooks', [])
+        started = time.time()
+        downloaded = 0
+        with urllib.request.urlopen(info['url']) as resp, open(path, "wb") as f:
+            while chunk := resp.read(64 * 1024):
+                f.write(chunk)
+                downloaded += len(chunk)
+                for hook in hooks:
+                    hook({
+                        'status': 'downloading',
+                        'filename': path,
+                        'downloaded_bytes': downloaded,
+                        'speed': downloaded / max(time.time() - started, 1e-6),
+                    })
+        for hook in hooks:
+            hook({
+                'status': 'finished',
+                'filename': path,
+                'total_bytes': os.path.getsize(path),
+                'info_dict': {**info, '_filename': path},
+            })
+        info['requested_downloads'] = [{'filepath': path, 'filename': path}]
+        return info
+
+
+def fake_ffmpeg(cmd: list[str]) -> None:
+    """ Copies the first input to the output, like a stream copy pass """
+    shutil.copyfile(cmd[cmd.index("-i") + 1], cmd[-1])
+
+
+def install_fakes(server: ThreadingHTTPServer, media_size: int, extract_ms: int) -> None:
+    FakeYoutubeDL.server_url = f"http://127.0.0.1:{server.server_address[1]}"
+    FakeYoutubeDL.media_size = media_size
+    FakeYoutubeDL.extract_ms = extract_ms
+    # main imports yt_dlp on use, so the module attribute is patched
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    main.run_ffmpeg = fake_ffmpeg
+
+
+def make_items(count: int) -> list[dict]:
+    return [
+        {
+            'type': 'video',
+            'url': f"https://www.youtube.com/watch?v=bench{i:06d}",
+            'filename': f"{i:06d}.%(title)s",
+        }
+        for i in range(count)
+    ]
+
+
+def make_context(output: str, workers: int) -> main.Context:
+    return main.Context(output=output, workers=workers, use_archive=False, metadata_ttl=0)
+
+
+def timed(func, *args) -> float:
+    main.metadata_cache.clear()
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def run_orchestration(sizes: list[int], workers: list[int], media_size: int) -> list[dict]:
+    results = []
+    # first run pays for lazy imports and connection setup
+    timed(main.manage_threads, make_items(max(workers)), "", make_context(tempfile.mkdtemp(dir="."), max(workers)))
+    for size in sizes:
+        for count in workers:
+            output = tempfile.mkdtemp(prefix="out_", dir=".")
+            context = make_context(output, count)
+            makespan = timed(main.manage_threads, make_items(size), "", context)
+            results.append({
+                'target': "manage_threads",
+                'items': size,
+                'workers': count,
+                'makespan_s': round(makespan, 4),
+                'items_per_s': round(size / makespan, 2),
+                'mb_per_s': round(size * media_size / makespan / 1e6, 2),
+            })
+
+            output = tempfile.mkdtemp(prefix="out_", dir=".")
+            context = make_context(output, count)
+            FakeYoutubeDL.playlist_size = size
+            makespan = timed(main.main, "https://www.youtube.com/playlist?list=bench", context)
+            results.append({
+                'target': "main.main (playlist)",
+                'items': size,
+                'workers': count,
+                'makespan_s': round(makespan, 4),
+                'items_per_s': round(size / makespan, 2),
+                'mb_per_s': round(size * media_size / makespan / 1e6, 2),
+            })
+            print(f"{size} items, {count} workers: {results[-2]['items_per_s']} items/s")
+
+    output = tempfile.mkdtemp(prefix="out_", dir=".")
+    context = make_context(output, 1)
+    runs = [timed(main.download_item, item, "", context) for item in make_items(20)]
+    results.append({
+        'target': "download_item",
+        'items': len(runs),
+        'workers': 1,
+        'mean_s': round(sum(runs) / len(runs), 4),
+        'min_s': round(min(runs), 4),
+    })
+    return results
+
+
+def run_micro() -> dict:
+    lines = [
+        f"audio ; https://music.youtube.com/watch?v=micro{i:06d} ; {i:05d} song %(title)s\n"
+        for i in range(10000)
+    ]
+    names = [f'Some: "title" / part {i} <live>?.mp3' for i in range(10000)]
+    completed = [
+        main.DownloadResult(item, status="done" if i % 10 else "failed")
+        for i, item in enumerate(make_items(10000))
+    ]
+    cases = {
+        'parse_items_10k': lambda: main.parse_items(lines),
+        'clean_filename_10k': lambda: [main.clean_filename(n) for n in names],
+        'split_results_10k': lambda: main.split_results(completed),
+    }
+    result = {}
+    for name, case in cases.items():
+        runs = timeit.repeat(case, number=1, repeat=5)
+        result[name] = {'best_s': round(min(runs), 6), 'mean_s': round(sum(runs) / len(runs), 6)}
+    return result
+
+
+def get_arg(names: tuple, default: str) -> str:
+    for name in names:
+        if name in sys.argv:
+            index = sys.argv.index(name)
+            if index < len(sys.argv) - 1:
+                return sys.argv[index + 1]
+    return default
+
+
+def run():
+    sizes = [int(x) for x in get_arg(("-s", "--sizes"), "50,200").split(",")]
+    workers = [int(x) for x in get_arg(("-w", "--workers"), "1,4,8,16").split(",")]
+    media_size = int(get_arg(("-m", "--media-kb"), "256")) * 1024
+    latency_ms = int(get_arg(("-l", "--latency-ms"), "20"))
+    extract_ms = int(get_arg(("-e", "--extract-ms"), "30"))
+    output = os.path.abspath(get_arg(("-o", "--output"), "benchmark_results.json"))
+
+    # main logs every item, keep the output to the results
+    logging.getLogger().setLevel(logging.CRITICAL + 1)
+    server = start_server(latency_ms)
+    install_fakes(server, media_size, extract_ms)
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="yt_bench_")
+    try:
+        os.chdir(workdir)
+        orchestration = run_orchestration(sizes, workers, media_size)
+        micro = run_micro()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.shutdown()
+
+    try:
+        with open(".version", "r") as f:
+            version = f.read().strip()
+    except OSError:
+        version = None
+    report = {
+        'version': version,
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {
+            'media_bytes': media_size,
+            'latency_ms': latency_ms,
+            'extract_ms': extract_ms,
+        },
+        'orchestration': orchestration,
+        'micro': micro,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    for row in orchestration:
+        print(row)
+    for name, row in micro.items():
+        print(name, row)
+    print(f"Results were saved to {output}")
+
+
+if __name__ == "__main__":
+    run()
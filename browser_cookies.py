@@ -0,0 +1,85 @@
+## browser cookies decrypted once and shared by all download workers
+import cfg
+import time
+import logging
+import threading
+
+
+AUTH_ERROR_MESSAGES = (
+    "sign in to confirm",
+    "cookies are no longer valid",
+    "login required",
+    "http error 401",
+    "members-only",
+    "join this channel",
+    "private video",
+)
+
+
+def is_auth_error(e: Exception) -> bool:
+    message = str(e).lower()
+    return any(x in message for x in AUTH_ERROR_MESSAGES)
+
+
+def copy_jar(jar):
+    """ New jar with the same cookies, yt-dlp adds response cookies to the
+    jar it is given so workers must not share one """
+    from yt_dlp.cookies import YoutubeDLCookieJar
+    copy = YoutubeDLCookieJar()
+    for cookie in jar:
+        copy.set_cookie(cookie)
+    return copy
+
+
+class CookieStore:
+    """ Cookies of a browser read on first use and kept for ttl seconds,
+    instead of every YoutubeDL opening and decrypting the browser database.
+    Each generation is one extraction, refresh() drops the current one after
+    an authentication failure """
+
+    def __init__(self, browser: str, ttl: float):
+        self.browser = browser
+        self.ttl = ttl
+        self.source = None
+        self.loaded = 0.0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def ensure(self) -> int:
+        """ Extracts the cookies if there are none or they are older than
+        ttl, returns the current generation """
+        with self.lock:
+            self._load()
+            return self.generation
+
+    def jar(self) -> tuple:
+        """ (copy of the jar, generation) """
+        with self.lock:
+            self._load()
+            return copy_jar(self.source), self.generation
+
+    def _load(self) -> None:
+        if self.source is None or time.time() - self.loaded > self.ttl:
+            from yt_dlp.cookies import extract_cookies_from_browser
+            started = time.time()
+            self.source = extract_cookies_from_browser(self.browser)
+            self.loaded = time.time()
+            self.generation += 1
+            logging.info(
+                f"Loaded {len(self.source)} cookies from {self.browser} "
+                f"in {self.loaded - started:.1f}s"
+            )
+
+    def refresh(self, generation: int) -> bool:
+        """ Called after an authentication failure with cookies of generation.
+        Returns True if the next attempt gets other cookies """
+        with self.lock:
+            if generation != self.generation:
+                # another worker already had them refreshed
+                return True
+            if time.time() - self.loaded < cfg.COOKIES_MIN_AGE:
+                # just extracted, reading them again gives the same cookies
+                return False
+            logging.info(f"Cookies from {self.browser} will be read again")
+            self.source = None
+            return True
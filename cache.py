@@ -0,0 +1,112 @@
+## caches shared between download workers
+import os
+import time
+import hashlib
+import threading
+from pathlib import Path
+
+
+class TTLCache:
+    """ Thread-safe in-memory cache, entries expire ttl seconds after set.
+    When max_items is reached the oldest entry is dropped """
+
+    def __init__(self, ttl: float, max_items: int = 4096):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.time():
+                del self.items[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.items.pop(key, None)
+            while len(self.items) >= self.max_items:
+                del self.items[next(iter(self.items))]
+            self.items[key] = (time.time() + ttl, value)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.items.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+
+
+class FileCache:
+    """ Directory of files named by the sha256 of their key.
+    Least recently used files are evicted once the directory grows over max_bytes """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def path(self, key: str) -> Path:
+        return self.directory / hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Path | None:
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get_or_fill(self, key: str, fill) -> Path:
+        """ Cached file for key, calls fill(path) to create it on a miss.
+        Concurrent misses for the same key wait for a single fill """
+        path = self.get(key)
+        if path is not None:
+            return path
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            path = self.get(key)
+            if path is not None:
+                return path
+            path = self.path(key)
+            self.directory.mkdir(parents=True, exist_ok=True)
+            temp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            try:
+                fill(temp_path)
+                os.replace(temp_path, path)
+            finally:
+                if temp_path.exists():
+                    temp_path.unlink()
+        self.evict()
+        return path
+
+    def evict(self) -> None:
+        with self.lock:
+            try:
+                files = [
+                    f for f in os.scandir(self.directory)
+                    if f.is_file() and not f.name.endswith(".tmp")
+                ]
+            except OSError:
+                return
+            files = [(f.stat().st_mtime, f.stat().st_size, f.path) for f in files]
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
@@ -5,14 +5,62 @@ import platform
 
 ## CONSTANTS
 MAX_THREADS = 8
+MIN_WORKERS = 1  ## adaptive concurrency never goes below this
+ADAPTIVE_COOLDOWN = 10  ## seconds between concurrency changes after throttling
+THROTTLED_SPEED = 64 * 1024  ## bytes/s, slower downloads count as throttled
+PLAYLIST_WORKERS = 4  ## playlists of an input file expanded at once
+RETRY_ATTEMPTS = 4  ## attempts per item, transient errors only
+RETRY_BACKOFF = 2  ## seconds before the first retry, doubled after each attempt
+RETRY_BACKOFF_MAX = 120  ## seconds
+HOST_LIMITS = {  ## host: (parallel downloads or None for all workers, seconds between download starts)
+    "youtube.com": (None, 0),
+    "music.youtube.com": (4, 0.5),
+    "instagram.com": (2, 3),
+}
+HOST_ALIASES = {"youtu.be": "youtube.com"}
+HTTP_TIMEOUT = 12  ## seconds
+HTTP_POOL_HOSTS = 16
+HTTP_CONNECTIONS_PER_HOST = MAX_THREADS
+METADATA_CACHE_TTL = 1800  ## seconds, format urls expire after a few hours
+METADATA_CACHE_SIZE = 256  ## items waiting for a retry whose metadata is kept
+RESTORE_CACHE_FILE = "cache/restored_links.json"
+RESTORE_CACHE_TTL = 24 * 3600  ## seconds a restored youtube music link is reused
+RESTORE_NEGATIVE_TTL = 3600  ## seconds a failed restore is not tried again
+RESTORE_WORKERS = 4  ## youtube music pages fetched at once
+RESTORE_MAX_BYTES = 2 * 1024 * 1024  ## read from a page before giving up on finding the link
+COOKIES_TTL = 1800  ## seconds browser cookies are used before being read again
+COOKIES_MIN_AGE = 60  ## seconds, fresher cookies are not read again after an auth error
 GIT_LINK = "https://github.com/BlogPlayCode/yt_playlist_downloader"
 DONATE_URL = "https://t.me/NktBlgv"
 ALLOWED_BROWSERS = ['brave', 'chrome', 'chromium', 'edge', 'firefox', 'opera', 'safari', 'vivaldi', 'whale']
 SETTINGS_FILE = "saved_settings.json"
+ARCHIVE_FILE = "download_index.sqlite3"
+METRICS_DIR = "logs"
+JOURNAL_DIR = "cache/journal"
+JOURNAL_SYNC_INTERVAL = 1  ## seconds between fsyncs of the run journal
+METADATA_BATCH_SIZE = 100  ## metadata lines written at once
+METADATA_FLUSH_INTERVAL = 1  ## seconds queued metadata waits for a batch to fill
+INFO_DUMP_DIR = "logs/info"  ## full extract_info dumps, with --dump-info only
+PLAN_AUDIO_BYTERATE = 16 * 1024  ## bytes per second of media, for items without a known size
+PLAN_VIDEO_BYTERATE = 320 * 1024
+PLAN_DEFAULT_DURATION = 240  ## seconds, for items without a known duration
+PLAN_WORKER_SPEED = 2 * 1024 * 1024  ## bytes/s one download is assumed to get
+PLAN_ITEM_OVERHEAD = 3  ## seconds of extraction and post-processing per item
+THUMBNAIL_CACHE_DIR = "cache/thumbnails"
+THUMBNAIL_CACHE_SIZE = 64 * 1024 * 1024  ## bytes
+AUDIO_PROFILES = ("mp3-320", "mp3-vbr", "passthrough")
+VERSION_CACHE_FILE = "cache/version.json"
+VERSION_CHECK_TTL = 6 * 3600  ## seconds the latest version is not fetched again
+OUTPUT_DIR_CACHE_FILE = "cache/output_dir.json"
+LAUNCH_CHECKS_WAIT = 0.5  ## seconds the prompt waits for background launch checks
+DAEMON_PORT = 8765
+DAEMON_MAX_JOBS = 4  ## jobs running at once, downloads of all of them share MAX_THREADS
+DAEMON_JOBS_DIR = "cache/jobs"
 
 ## DEFAULTS
 DEFAULT_OUTPUT_DIR = "result"  ## may be changed depending on the platform
 COOKIES = None
+DEFAULT_AUDIO_PROFILE = "mp3-320"
 
 ## ENVIRON
 IS_MOBILE = False
@@ -24,18 +72,31 @@ if "android" in platform.release().lower():
     IS_MOBILE = True
 
 if IS_MOBILE:
+    # probing writes to the storage, the result is reused by the next launches
     try:
-        test_dir = "/storage/emulated/0/Download"
-        with open(os.path.join(test_dir, "test.mp3"), "wb") as f:
-            f.write(b"test")
-        test_dir = os.path.join(test_dir, "yt_playlist_downloader")
-        os.makedirs(test_dir, exist_ok=True)
-        DEFAULT_OUTPUT_DIR = test_dir
+        with open(OUTPUT_DIR_CACHE_FILE, "r", encoding="utf-8") as f:
+            DEFAULT_OUTPUT_DIR = json.load(f)["output_dir"]
+        if not os.path.isdir(DEFAULT_OUTPUT_DIR):
+            raise FileNotFoundError(DEFAULT_OUTPUT_DIR)
     except:
-        test_dir = os.path.join(os.path.expanduser("~"), "Documents")
-        with open(os.path.join(test_dir, "test.mp3"), "wb") as f:
-            f.write(b"test")
-        DEFAULT_OUTPUT_DIR = test_dir
+        try:
+            test_dir = "/storage/emulated/0/Download"
+            with open(os.path.join(test_dir, "test.mp3"), "wb") as f:
+                f.write(b"test")
+            test_dir = os.path.join(test_dir, "yt_playlist_downloader")
+            os.makedirs(test_dir, exist_ok=True)
+            DEFAULT_OUTPUT_DIR = test_dir
+        except:
+            test_dir = os.path.join(os.path.expanduser("~"), "Documents")
+            with open(os.path.join(test_dir, "test.mp3"), "wb") as f:
+                f.write(b"test")
+            DEFAULT_OUTPUT_DIR = test_dir
+        try:
+            os.makedirs(os.path.dirname(OUTPUT_DIR_CACHE_FILE), exist_ok=True)
+            with open(OUTPUT_DIR_CACHE_FILE, "w", encoding="utf-8") as f:
+                json.dump({"output_dir": DEFAULT_OUTPUT_DIR}, f)
+        except OSError:
+            pass
     
 ## TEXTS
 LOGO = """
@@ -57,6 +118,16 @@ Options:
   -sv,          --save-settings     Save current settings to be used as defaults in the future
   -o [DIR],     --output [DIR]      Specify output directory (default: ./output)
   -c [BROWSER], --cookies [BROWSER] Use cookies from [BROWSER] in the current directory
+  -w [N],       --workers [N]       Number of parallel downloads (default: 8)
+  -mt [SEC],    --metadata-ttl [SEC] Reuse extracted metadata on retries for SEC seconds (0 to disable)
+  -lr [RATE],   --limit-rate [RATE] Total download bandwidth for all workers, e.g. 500K or 4M
+  -hl [LIMITS], --host-limit [LIMITS] Parallel downloads and seconds between starts per host, e.g. instagram.com=2:3,youtube.com=6
+  -na,          --no-archive        Download again items already recorded in the download index
+  -ap [NAME],   --audio-profile [NAME] Default audio output: mp3-320, mp3-vbr or passthrough (opus/m4a as downloaded)
+  -ps,          --profile-startup   Print how long the startup and the launch checks took
+  -d [PORT],    --daemon [PORT]     Run in background mode taking jobs over http on localhost (default port: 8765)
+  -p,           --plan              Only print the estimated size and time of an input with the current workers
+  -di,          --dump-info         Also save the full extracted info of every item and playlist to logs/info
 """.strip("\n")
 BAD_CONNECTION_MESSAGE = r"""
           /\
@@ -82,5 +153,7 @@ https://music.youtube.com/watch?v=example
 or
 audio ; https://music.youtube.com/watch?v=example ; song file name
 or
+audio:passthrough ; https://music.youtube.com/watch?v=example ; song file name
+or
 video ; https://youtube.com/watch?v=example ; video file name
 """
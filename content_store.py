@@ -0,0 +1,43 @@
+## finished files reused for the same video in other directories
+import os
+import shutil
+import logging
+
+
+FICLONE = 0x40049409  # linux ioctl sharing the extents of another file
+
+
+def reflink(source: str, target: str) -> None:
+    """ Copy-on-write clone, only btrfs, xfs and similar support it """
+    import fcntl
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+
+
+def link_file(source: str, target: str) -> str:
+    """ Makes target a hardlink of source, or a reflink or copy where links
+    are not possible (other filesystem, FAT, Android storage). Returns the
+    method used """
+    try:
+        os.link(source, target)
+        return "hardlink"
+    except OSError as e:
+        logging.debug(f"Hardlink {target} failed: {e}")
+    try:
+        reflink(source, target)
+        return "reflink"
+    except (OSError, ImportError) as e:
+        logging.debug(f"Reflink {target} failed: {e}")
+    temp_path = f"{target}.temp{os.path.splitext(target)[1]}"
+    try:
+        shutil.copyfile(source, temp_path)
+        os.replace(temp_path, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return "copy"
@@ -0,0 +1,225 @@
+## long running mode taking jobs over a local http api
+##
+## POST /jobs       {"url": ...} or {"entry": "audio ; url ; name"} or {"file": "input.txt"},
+##                  optional "output" directory inside the configured one. Returns the job.
+##                  Bodies must be sent as application/json, browsers preflight such
+##                  requests and the api never allows them, so web pages can not add jobs
+## GET  /jobs       every job
+## GET  /jobs/<id>  state and progress of a job
+## GET  /status     shared download slots, bandwidth and http pool stats
+import os
+import cfg
+import json
+import time
+import logging
+import threading
+import itertools
+import dataclasses
+import net
+import main
+from journal import journal_path, remove_files
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str  # "url", "entry" or "file"
+    input: str
+    output: str
+    state: str = "queued"  # "running", "finished" or "error"
+    error: str = None
+    created: float = field(default_factory=time.time)
+    started: float = None
+    finished: float = None
+    done: int = 0
+    failed: int = 0
+    retries: int = 0
+    bytes: int = 0
+    last: str = None  # file name of the last finished item
+
+    def to_dict(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+class Daemon:
+    """ Runs jobs concurrently with main.main(). Every job gets a copy of
+    the context sharing its throttle and cookies, so downloads of all jobs
+    together stay within context.workers and the bandwidth cap """
+
+    def __init__(self, context: main.Context):
+        self.context = context
+        main.get_throttle(context)
+        if context.cookies:
+            main.get_cookie_store(context)
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(cfg.DAEMON_MAX_JOBS)
+
+    def submit(self, request: dict) -> Job:
+        kinds = [kind for kind in ("url", "entry", "file") if request.get(kind)]
+        if len(kinds) != 1:
+            raise ValueError("Expected one of url, entry or file")
+        kind = kinds[0]
+        text = str(request[kind]).strip()
+        if kind == "url" and not text.startswith("http"):
+            raise ValueError("url must start with http")
+        if kind == "entry":
+            try:
+                main.parse_items(text.split("\n"))
+            except ValueError as e:
+                raise ValueError(f"Expected 'type ; url ; name' lines: {e}")
+        if kind == "file" and not os.path.isfile(text):
+            raise ValueError(f"File not found: {text}")
+        output = self.output_dir(request.get("output"))
+        with self.lock:
+            job = Job(next(self.ids), kind, text, output)
+            self.jobs[job.id] = job
+        threading.Thread(target=self.run, args=(job,), name=f"job-{job.id}", daemon=True).start()
+        logging.info(f"Job {job.id} queued: {kind} {text}")
+        return job
+
+    def output_dir(self, requested) -> str:
+        """ Requested directory, relative to the configured output, which
+        jobs can not leave """
+        root = os.path.realpath(self.context.output)
+        if not requested:
+            return self.context.output
+        output = os.path.realpath(os.path.join(root, str(requested)))
+        if os.path.commonpath([root, output]) != root:
+            raise ValueError(f"output must be inside {self.context.output}")
+        return output
+
+    def on_result(self, job: Job, result: main.DownloadResult) -> None:
+        with self.lock:
+            if result.retry:
+                job.retries += 1
+                return
+            if result.status == "done":
+                job.done += 1
+                job.bytes += result.bytes
+            else:
+                job.failed += 1
+            job.last = result.item.get('filename')
+
+    def run(self, job: Job) -> None:
+        with self.slots:
+            job.state = "running"
+            job.started = time.time()
+            context = dataclasses.replace(
+                self.context,
+                output=job.output,
+                single_input=False,
+                journal=None,
+                on_result=lambda result: self.on_result(job, result),
+            )
+            input_file = None
+            try:
+                if job.kind == "url" and "/playlist" in job.input:
+                    main.main(job.input, context)
+                else:
+                    if job.kind == "file":
+                        input_file = job.input
+                    else:
+                        # single urls and entries run through the pools like a file
+                        input_file = os.path.join(cfg.DAEMON_JOBS_DIR, f"{int(job.created)}-{job.id}.txt")
+                        os.makedirs(cfg.DAEMON_JOBS_DIR, exist_ok=True)
+                        lines = main.url_entry(job.input) if job.kind == "url" else job.input
+                        with open(input_file, "w", encoding="utf-8") as f:
+                            f.write(lines + "\n")
+                    main.main("file", context, input_file)
+                job.state = "finished"
+            except Exception as e:
+                job.state = "error"
+                job.error = f"{type(e).__name__}: {e}"
+                logging.error(f"Job {job.id} failed: {job.error}")
+            finally:
+                job.finished = time.time()
+                if job.kind != "file" and input_file:
+                    # one-off inputs, their journal can not be resumed either
+                    source = f"file:{os.path.abspath(input_file)}"
+                    remove_files(input_file, journal_path(source, context.output))
+        logging.info(f"Job {job.id} {job.state}: {job.done} done, {job.failed} failed")
+
+    def status(self) -> dict:
+        throttle = main.get_throttle(self.context)
+        with self.lock:
+            states = {}
+            for job in self.jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+        return {
+            'jobs': states,
+            'downloads': {'active': throttle.limit.active, 'limit': throttle.limit.limit},
+            'hosts': throttle.hosts.stats(),
+            'postprocessing': {'active': throttle.postprocess_limit.active, 'limit': throttle.postprocess_limit.limit},
+            'bandwidth': throttle.meter.rate(),
+            'http': net.stats(),
+        }
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    daemon: Daemon = None
+
+    def send_json(self, code: int, data) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path == "/jobs":
+            with self.daemon.lock:
+                jobs = [job.to_dict() for job in self.daemon.jobs.values()]
+            self.send_json(200, {'jobs': jobs})
+        elif path.startswith("/jobs/"):
+            job = self.daemon.jobs.get(int(path[6:])) if path[6:].isdigit() else None
+            if job is None:
+                self.send_json(404, {'error': "No such job"})
+            else:
+                with self.daemon.lock:
+                    data = job.to_dict()
+                self.send_json(200, data)
+        elif path == "/status":
+            self.send_json(200, self.daemon.status())
+        else:
+            self.send_json(404, {'error': "Not found"})
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0].rstrip("/") != "/jobs":
+            self.send_json(404, {'error': "Not found"})
+            return
+        content_type = (self.headers.get("Content-Type") or "").split(";", 1)[0].strip().lower()
+        if content_type != "application/json":
+            self.send_json(415, {'error': "Expected Content-Type: application/json"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("Expected a json object")
+            job = self.daemon.submit(request)
+        except Exception as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(201, job.to_dict())
+
+    def log_message(self, format, *args):
+        logging.debug(f"API {self.address_string()} {format % args}")
+
+
+def serve(context: main.Context, port: int = cfg.DAEMON_PORT) -> None:
+    """ Blocks until interrupted, the api only listens on localhost """
+    ApiHandler.daemon = Daemon(context)
+    server = ThreadingHTTPServer(("127.0.0.1", port), ApiHandler)
+    server.daemon_threads = True
+    logging.info(f"Daemon listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        main.ydl_pool.clear()
@@ -0,0 +1,162 @@
+## append-only journal of a run, an interrupted run of the same input is resumed
+import os
+import cfg
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Iterable, Iterator
+
+
+def journal_path(inp: str, output: str) -> str:
+    name = hashlib.sha1(f"{inp}\n{output}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cfg.JOURNAL_DIR, f"{name}.jsonl")
+
+
+def job_key(item: dict) -> str:
+    """ Identity of an input item across runs, kept in the item so it
+    survives url changes of retries """
+    if 'job' not in item:
+        key = f"{item['type']}|{item['url']}|{item['filename']}"
+        if item.get('catalogue'):
+            # the same playlist entry expanded into two folders of one input file
+            key += f"|{item['catalogue']}"
+        item['job'] = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return item['job']
+
+
+def remove_files(*paths: str) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+            logging.debug(f"Removed leftover {path}")
+        except OSError:
+            pass
+
+
+class Journal:
+    """ One JSON line per event: queued, started, downloaded, postprocess,
+    done or failed per item, plus input, complete (every item was queued)
+    and finished for the run. Lines are flushed right away and fsynced at
+    most every cfg.JOURNAL_SYNC_INTERVAL seconds and on close.
+    A journal that was not finished is loaded and continued, one that was
+    is started over. finish() removes the file, there is nothing to resume """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.items = {}  # job key -> item, in queue order
+        self.states = {}  # job key -> last event record
+        self.playlist = None
+        self.complete = False
+        self.finished = False
+        self.file = None
+        self.synced = time.monotonic()
+        self._load()
+        if self.finished:
+            self.items.clear()
+            self.states.clear()
+            self.playlist = None
+            self.complete = self.finished = False
+            mode = "w"
+        else:
+            mode = "a"
+        self.resumed = bool(self.items)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, mode, encoding="utf-8")
+
+    def _load(self) -> None:
+        try:
+            f = open(self.path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of a killed process may be cut off
+                    continue
+                self._apply(record)
+
+    def _apply(self, record: dict) -> None:
+        event = record.get('event')
+        if event == "input":
+            self.playlist = record.get('playlist')
+            self.complete = self.finished = False
+        elif event == "complete":
+            self.complete = True
+        elif event == "finished":
+            self.finished = True
+        elif 'job' in record:
+            if event == "queued":
+                self.items[record['job']] = record['item']
+            self.states[record['job']] = record
+
+    def _write(self, record: dict) -> None:
+        record['time'] = round(time.time(), 3)
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            if self.file is None or self.file.closed:
+                return
+            self.file.write(line + "\n")
+            self.file.flush()
+            if time.monotonic() - self.synced >= cfg.JOURNAL_SYNC_INTERVAL:
+                os.fsync(self.file.fileno())
+                self.synced = time.monotonic()
+            self._apply(record)
+
+    def start(self, inp: str, playlist: str = None) -> None:
+        self._write({'event': "input", 'input': inp, 'playlist': playlist})
+
+    def record(self, event: str, item: dict, **data) -> None:
+        self._write({'event': event, 'job': job_key(item), **data})
+
+    def state(self, item: dict) -> str | None:
+        record = self.states.get(job_key(item))
+        return record['event'] if record else None
+
+    def queue(self, items: Iterable[dict], skipped: list = None) -> Iterator[dict]:
+        """ Yields items not done by a previous run and journals new ones,
+        complete is written once items is exhausted """
+        for item in items:
+            if self.state(item) == "done":
+                if skipped is not None:
+                    skipped.append(item)
+                continue
+            if job_key(item) not in self.items:
+                self._write({'event': "queued", 'job': job_key(item), 'item': item})
+            yield item
+        self._write({'event': "complete"})
+
+    def unfinished(self) -> list[dict]:
+        return [
+            item for key, item in self.items.items()
+            if self.states[key]['event'] != "done"
+        ]
+
+    def collect_garbage(self) -> None:
+        """ Removes temp files the journal knows to be orphaned: ffmpeg output
+        of an interrupted post-processing and partial downloads of items that
+        failed permanently. Partial downloads of other items are kept for
+        yt-dlp to continue """
+        for record in list(self.states.values()):
+            if record['event'] == "postprocess" and record.get('temp'):
+                remove_files(record['temp'])
+            elif record['event'] == "failed" and record.get('permanent') and record.get('partial'):
+                remove_files(record['partial'], f"{record['partial']}.ytdl")
+
+    def finish(self) -> None:
+        self._write({'event': "finished"})
+        self.collect_garbage()
+        self.close()
+        remove_files(self.path)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is None or self.file.closed:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
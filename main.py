@@ -3,16 +3,36 @@ import os
 import sys
 import cfg
 import time
-import json
-import yt_dlp
+import net
+import archive
+from metrics import RunMetrics
+from throttle import Throttle, is_throttle_error
+from retry import is_transient, backoff_delay
+from journal import Journal, journal_path
+from browser_cookies import CookieStore, is_auth_error
+from cache import FileCache, TTLCache
+from ydl_pool import YoutubeDLPool
+from content_store import link_file
+from metadata_store import MetadataStore
+from music_links import LinkRestorer
+import plan
+import queue
+import base64
+import struct
 import logging
-import tempfile
-import requests
+import itertools
 import importlib
+import threading
 import subprocess
 from pathlib import Path
-from threading import Thread
-from dataclasses import dataclass
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+from pool import Task, WorkerPool
+
+# yt_dlp is imported where it is used, importing it takes most of the startup
+if TYPE_CHECKING:
+    import yt_dlp
 
 
 @dataclass
@@ -21,13 +41,66 @@ class Context:
     launch_checks: bool = True
     output: str = cfg.DEFAULT_OUTPUT_DIR
     cookies: str = cfg.COOKIES
+    use_archive: bool = True
+    workers: int = cfg.MAX_THREADS
+    metadata_ttl: int = cfg.METADATA_CACHE_TTL
+    postprocess_workers: int = os.cpu_count() or 1
+    rate_limit: int = 0  # bytes per second for all workers, 0 for no limit
+    host_limits: dict = field(default_factory=dict)  # overrides of cfg.HOST_LIMITS
+    audio_profile: str = cfg.DEFAULT_AUDIO_PROFILE  # for audio items without one
+    dump_info: bool = False  # full extract_info dumps besides the metadata store
+    plan_only: bool = False  # inputs are estimated by plan_input instead of downloaded
+    throttle: Throttle = field(default=None, repr=False, compare=False)
+    journal: Journal = field(default=None, repr=False, compare=False)
+    cookie_store: CookieStore = field(default=None, repr=False, compare=False)
+    metadata: MetadataStore = field(default=None, repr=False, compare=False)
+    on_result: Callable = field(default=None, repr=False, compare=False)  # called by main() after every attempt
+
+
+@dataclass
+class DownloadResult:
+    item: dict
+    status: str = "failed"  # "done" or "failed"
+    path: str = None
+    bytes: int = 0
+    downloaded_bytes: int = 0
+    attempts: int = 1
+    timings: dict = field(default_factory=dict)  # phase name -> seconds
+    error: str = None  # exception class name
+    message: str = None
+    pending: dict = None  # downloaded info until post-processing is done
+    transient: bool = False  # another attempt may succeed
+    partial: str = None  # .part file left by a failed download
+    retry: bool = False  # another attempt is scheduled
+    linked: str = None  # how a file from the content store was reused, if it was
+
+
+# ffmpeg output of the audio profiles, passthrough depends on the downloaded codec
+AUDIO_CODECS = {
+    'mp3-320': ("mp3", ["-c:a", "libmp3lame", "-b:a", "320k", "-id3v2_version", "3"]),
+    'mp3-vbr': ("mp3", ["-c:a", "libmp3lame", "-q:a", "2", "-id3v2_version", "3"]),
+}
+# containers without picture streams, covers go to a METADATA_BLOCK_PICTURE tag
+OGG_EXTENSIONS = ("opus", "ogg")
+SQUARE_CROP = r"crop=min(iw\,ih):min(iw\,ih):(iw-ow)/2:(ih-oh)/2"
+
+# extract_info results of failed attempts by (extractor, video id), taken by their retry
+metadata_cache = TTLCache(cfg.METADATA_CACHE_TTL, cfg.METADATA_CACHE_SIZE)
+thumbnail_cache = FileCache(cfg.THUMBNAIL_CACHE_DIR, cfg.THUMBNAIL_CACHE_SIZE)
+# YoutubeDL instances by (format, cookies browser), shared by all workers,
+# manage_threads sizes it to context.workers
+ydl_pool = YoutubeDLPool(1)
+_link_restorer = None
+_link_restorer_lock = threading.Lock()
 
 
 def save_to_file(content: str, filename: str = 'input.txt') -> None:
     with open(filename, 'w', encoding='utf-8') as f:
         f.write("""
 # audio ; http://link.com ; song %(title)s
+# audio:passthrough ; http://link.com ; song %(title)s
 # video ; https://link.com ; video %(title)s
+# https://youtube.com/playlist?list=example
 
 
 """)
@@ -51,155 +124,514 @@ def clean_filename(filename: str, replacement="-") -> None:
     return cleaned
 
 
-def ytmusic_restore_link(old_link: str) -> str:
-    if "youtube.com/watch?" not in old_link:
-        return None
+def download_thumbnail(thumbnail_url: str, path: Path) -> None:
+    with net.get(thumbnail_url, stream=True, allow_redirects=True) as resp:
+        resp.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in resp.iter_content(8192):
+                f.write(chunk)
+
+
+def get_cover(thumbnail_url: str) -> Path | None:
+    """ Cached cover image, album playlists share covers so each url is fetched once """
     try:
-        url = old_link.split('youtube.com/watch?', 1)
-        url = "https://music.youtube.com/watch?" + url[1]
-        answer = requests.get(url)
-        answer.raise_for_status()
-        url = answer.text.split('://music.youtube.com/watch?v=', 1)[1]
-        url = url.split('"', 1)[0]
-        return f"https://music.youtube.com/watch?v={url}"
-    except:
+        return thumbnail_cache.get_or_fill(
+            thumbnail_url,
+            lambda path: download_thumbnail(thumbnail_url, path),
+        )
+    except Exception as e:
+        logging.warning(f"Thumbnail download error {thumbnail_url}: {e}")
         return None
 
 
-def add_square_thumbnail_to_audio(audio_path: str, thumbnail_url: str) -> bool:
-    audio_path = Path(audio_path).resolve()
-    if not audio_path.is_file():
-        logging.warning(f"[{audio_path}] File not found")
-        return False
+def jpeg_size(data: bytes) -> tuple[int, int]:
+    """ (width, height) from the frame header of a jpeg """
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF or data[i + 1] == 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return 0, 0
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdir = Path(tmpdir)
-        temp_image = tmpdir / "thumb_original.jpg"
-        temp_square = tmpdir / "thumb_square.jpg"
 
+def vorbis_picture(image: Path) -> Path | None:
+    """ ffmetadata file with the image cropped to a square as a base64 FLAC
+    picture block, which is how Ogg (opus, vorbis) files carry covers """
+    def fill(path: Path):
+        jpeg = path.with_suffix(".jpg.tmp")
         try:
-            resp = requests.get(
-                thumbnail_url,
-                timeout=12,
-                stream=True,
-                allow_redirects=True,
-            )
-            resp.raise_for_status()
-            
-            with open(temp_image, "wb") as f:
-                for chunk in resp.iter_content(8192):
-                    f.write(chunk)
-        except Exception as e:
-            logging.warning(f"[{audio_path}] Thumbnail download error: {e}")
-            return False
+            run_ffmpeg([
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-i", str(image),
+                "-filter:v", SQUARE_CROP,
+                "-frames:v", "1", "-c:v", "mjpeg", "-f", "mjpeg",
+                str(jpeg),
+            ])
+            data = jpeg.read_bytes()
+        finally:
+            if jpeg.exists():
+                jpeg.unlink()
+        width, height = jpeg_size(data)
+        mime = b"image/jpeg"
+        block = (
+            struct.pack(">II", 3, len(mime)) + mime  # 3 is the front cover
+            + struct.pack(">IIIIII", 0, width, height, 24, 0, len(data)) + data
+        )
+        value = base64.b64encode(block).decode("ascii").replace("=", "\\=")
+        path.write_text(f";FFMETADATA1\nMETADATA_BLOCK_PICTURE={value}\n", encoding="utf-8")
 
-        cmd_crop = [
-            "ffmpeg", "-y",
-            "-loglevel", "quiet",
-            "-i", str(temp_image),
-            "-vf", r"crop=min(iw\,ih):min(iw\,ih):(iw-ow)/2:(ih-oh)/2",
-            "-update", "1",
-            str(temp_square)
-        ]
+    try:
+        return thumbnail_cache.get_or_fill(f"{image.name}:vorbis", fill)
+    except Exception as e:
+        logging.warning(f"Cover conversion error {image}: {e}")
+        return None
 
-        try:
-            subprocess.run(
-                cmd_crop,
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
-        except subprocess.CalledProcessError as e:
-            logging.warning(f"[{audio_path}] Image crop error: {e}")
-            return False
 
-        cmd_embed = [
-            "ffmpeg", "-y",
-            "-loglevel", "quiet",
-            "-i", str(temp_square),
-            "-i", str(audio_path),
-            "-map", "0:v",
-            "-map", "1:a",
-            "-map_metadata", "1","-c", "copy",
-            "-disposition:v", "attached_pic",
-            "-metadata:s:v", "title=Cover",
-            str(audio_path) + ".temp.mp3"
-        ]
+def cover_args(cover_input: int, ogg: bool = False) -> list[str]:
+    """ ffmpeg output args embedding input number cover_input as a square cover,
+    for Ogg the input is a vorbis_picture file """
+    if ogg:
+        return ["-map_metadata", str(cover_input)]
+    return [
+        "-map", f"{cover_input}:v",
+        "-filter:v", SQUARE_CROP,
+        "-c:v", "mjpeg",
+        "-disposition:v", "attached_pic",
+        "-metadata:s:v", "title=Cover",
+    ]
 
-        try:
-            subprocess.run(
-                cmd_embed,
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
-            
-            os.replace(str(audio_path) + ".temp.mp3", audio_path)
-            logging.info(f"[{audio_path}] Thumbnail was added successfully: {audio_path}")
-            return True
-            
-        except subprocess.CalledProcessError as e:
-            logging.warning(f"[{audio_path}] Thumbnail insert to audio file error: {e}")
-            if (audio_path.with_suffix(".temp.mp3")).exists():
-                (audio_path.with_suffix(".temp.mp3")).unlink()
-            return False
+
+def run_ffmpeg(cmd: list[str]) -> None:
+    try:
+        subprocess.run(
+            cmd,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+    except subprocess.CalledProcessError as e:
+        stderr = (e.stderr or b"").decode("utf-8", "replace").strip()
+        logging.debug(f"ffmpeg failed: {stderr[-1000:]}")
+        raise
 
 
-def remove_finished_threads(threads: list[Thread]) -> list[Thread]:
-    for thread in threads.copy():
-        if not thread.is_alive():
-            thread.join()
-            threads.remove(thread)
-    
-    return threads
+# query parameters of shared links that do not change what is downloaded
+TRACKING_PARAMS = {"si", "pp", "feature", "igsh", "igshid", "utm_source", "utm_medium", "utm_campaign"}
+TRACKING_RE = re.compile(rf"(?:^|&)(?:{'|'.join(TRACKING_PARAMS)})=")
+# anything normalize_url would change, most lines of large batches have nothing
+NORMALIZE_RE = re.compile(
+    rf"://(?:youtu\.be|youtube\.com|m\.youtube\.com)/|/shorts/|#|[A-Z].*://|://[^/]*[A-Z]|[?&](?:{'|'.join(TRACKING_PARAMS)})="
+)
+
+
+def normalize_url(url: str) -> str:
+    """ One spelling per video: youtu.be and shorts links become watch
+    links, tracking parameters and fragments are dropped """
+    url = url.strip()
+    if not NORMALIZE_RE.search(url):
+        return url
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    path = parts.path
+    query = parts.query
+    if TRACKING_RE.search(query):
+        query = urlencode([
+            (k, v) for k, v in parse_qsl(query, keep_blank_values=True) if k not in TRACKING_PARAMS
+        ])
+    if host == "youtu.be" and path.strip("/"):
+        host, path, query = "www.youtube.com", "/watch", "&".join(filter(None, [f"v={path.strip('/')}", query]))
+    elif host in ("youtube.com", "m.youtube.com"):
+        host = "www.youtube.com"
+    if host == "www.youtube.com" and path.startswith("/shorts/"):
+        path, query = "/watch", "&".join(filter(None, [f"v={path.split('/')[2]}", query]))
+    return urlunsplit((parts.scheme.lower(), host, path, query, ""))
+
+
+def parse_line(line: str) -> dict | None:
+    """ Item of an input line, None for blank lines and comments. A bare
+    url stands for url_entry(url). Raises ValueError with the reason """
+    line = line.strip()
+    if not line or line[0] == "#":
+        return None
+    if ";" not in line and line.startswith("http"):
+        line = url_entry(line)
+    parts = line.split(';', 2)
+    if len(parts) != 3:
+        raise ValueError("expected 'type ; url ; name'")
+    ftype, url, fname = (part.strip() for part in parts)
+    ftype, _, profile = ftype.lower().partition(':')
+    ftype, profile = ftype.strip(), profile.strip()
+    if ftype not in ("audio", "video"):
+        raise ValueError(f"unknown type '{ftype}', expected audio or video")
+    if not url.startswith(("http://", "https://")):
+        raise ValueError(f"'{url}' is not an http(s) url")
+    if not fname and "/playlist" not in url:
+        raise ValueError("empty file name")
+    item = {'type': ftype, 'filename': fname, 'url': normalize_url(url)}
+    if profile:
+        if profile not in cfg.AUDIO_PROFILES:
+            raise ValueError(f"Unknown audio profile '{profile}'")
+        item['profile'] = profile
+    return item
 
 
 def parse_items(lines: list[str]) -> list[dict]:
+    """ Raises on the first invalid line, see read_input_file for batches """
     items = []
     for line in lines:
-        line = line.strip()
-        if not line or line[0] == "#":
-            continue
-        ftype, url, fname = line.split(';', 2)
-        items.append({'type': ftype.strip(), 'filename': fname.strip(), 'url': url.strip()})
+        item = parse_line(line)
+        if item is not None:
+            items.append(item)
     
     return items
 
 
-def get_playlist(url: str) -> str:
+def item_profile(item: dict, context: Context) -> str:
+    """ Output profile of an item as kept in the download index,
+    "audio" stands for mp3-320 which was the only audio output before """
+    if item['type'] != 'audio':
+        return item['type']
+    profile = item.get('profile') or context.audio_profile
+    return "audio" if profile == "mp3-320" else f"audio:{profile}"
+
+
+_extractors = []
+_extractors_by_host = {}  # host -> extractor of its last matched url
+_extractors_lock = threading.Lock()
+
+
+def get_extractors() -> list:
+    """ yt-dlp extractor classes without Generic, never changed once filled """
+    with _extractors_lock:
+        if not _extractors:
+            import yt_dlp
+            _extractors.extend(
+                ie for ie in yt_dlp.extractor.gen_extractor_classes()
+                if ie.ie_key() != "Generic"
+            )
+        return _extractors
+
+
+def get_item_key(item: dict) -> tuple[str, str] | None:
+    """ (extractor, video id) of an item without any network requests """
+    if item.get('extractor') and item.get('id'):
+        return item['extractor'], item['id']
+    url = item['url']
+    host = urlsplit(url).netloc
+    # playlists and batches are usually from one site, try its last match first
+    ie = _extractors_by_host.get(host)
+    if ie is None or not ie.suitable(url):
+        ie = next((ie for ie in get_extractors() if ie.suitable(url)), None)
+        if ie is None:
+            return None
+        _extractors_by_host[host] = ie
+    video_id = ie.get_temp_id(url)
+    if not video_id:
+        return None
+    return ie.ie_key(), video_id
+
+
+def read_input_file(path: str, context: Context, errors: list = None) -> Iterator[dict]:
+    """ Items of an input file while it is read, so downloads start with the
+    first lines of large batches. Invalid lines are logged and appended to
+    errors as (line number, reason) instead of stopping the batch.
+    Playlist lines are expanded on cfg.PLAYLIST_WORKERS threads into a
+    folder named after the playlist (item['catalogue']), with the type of
+    the line. An item of the same video, profile and folder as an earlier
+    one is skipped """
+    if errors is None:
+        errors = []
+    expanded = queue.Queue()
+    seen = set()
+    counts = {'lines': 0, 'items': 0, 'duplicates': 0}
+
+    def report(number: int, reason: str) -> None:
+        errors.append((number, reason))
+        logging.warning(f"{path} line {number}: {reason}")
+
+    def unique(item: dict) -> bool:
+        key = get_item_key(item) or ("url", item['url'])
+        key = (*key, item_profile(item, context), item.get('catalogue', ""))
+        if key in seen:
+            counts['duplicates'] += 1
+            logging.debug(f"Duplicate of an earlier line, skipping {item['url']}")
+            return False
+        seen.add(key)
+        counts['items'] += 1
+        return True
+
+    def expand(number: int, line_item: dict) -> None:
+        try:
+            name, entries = get_playlist(line_item['url'], context.metadata)
+            logging.info(f"Expanding playlist '{name}' from line {number}")
+            for item in entries:
+                item['type'] = line_item['type']
+                if 'profile' in line_item:
+                    item['profile'] = line_item['profile']
+                item['catalogue'] = f"{name}/"
+                expanded.put(item)
+        except Exception as e:
+            report(number, f"playlist could not be expanded: {type(e).__name__} - {e}")
+
+    def drain() -> Iterator[dict]:
+        while True:
+            try:
+                item = expanded.get_nowait()
+            except queue.Empty:
+                return
+            if unique(item):
+                yield item
+
+    def close(pool: WorkerPool) -> None:
+        pool.close()
+        expanded.put(None)
+
+    pool = None
+    try:
+        with open(path, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                counts['lines'] = number
+                try:
+                    item = parse_line(line)
+                except ValueError as e:
+                    report(number, str(e))
+                    continue
+                if item is None:
+                    pass
+                elif "/playlist" in item['url']:
+                    if pool is None:
+                        pool = WorkerPool(expand, cfg.PLAYLIST_WORKERS, name="playlist")
+                    pool.submit(number, item)
+                elif unique(item):
+                    yield item
+                yield from drain()
+        if pool is not None:
+            threading.Thread(target=close, args=(pool,), daemon=True).start()
+            for item in iter(expanded.get, None):
+                if unique(item):
+                    yield item
+        logging.info(
+            f"Read {counts['lines']} lines: {counts['items']} items, "
+            f"{counts['duplicates']} duplicates, {len(errors)} invalid"
+        )
+    finally:
+        if pool is not None:
+            # stops expanding when the consumer gave up early
+            pool.cancel()
+
+
+def filter_archived(
+    items: Iterable[dict],
+    directory: str,
+    context: Context = None,
+    skipped: list = None,
+) -> Iterator[dict]:
+    """ Yields items missing from the download index, skipped ones are
+    appended to skipped """
+    if not context:
+        context = Context()
+    if not context.use_archive:
+        yield from items
+        return
+    index = archive.get_index(cfg.ARCHIVE_FILE)
+    for item in items:
+        key = get_item_key(item)
+        item_directory = f"{directory}{item.get('catalogue', '')}"
+        if key and index.is_downloaded(*key, item_profile(item, context), item_directory):
+            logging.debug(f"Already downloaded, skipping {item['url']}")
+            if skipped is not None:
+                skipped.append(item)
+            continue
+        yield item
+
+
+def get_playlist(url: str, metadata: MetadataStore = None) -> tuple[str, Iterator[dict]]:
+    """ Playlist name and a generator of its items. Pages are fetched while
+    the generator is consumed, so downloads start before the playlist is
+    fully expanded. Entries are recorded in metadata """
     url = url.strip()
     ydl_opts = {
         'quiet': True,
         'extract_flat': 'in_playlist',
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-    
-    import json
-    with open("playlist.json", "w", encoding="utf-8") as f:
-        json.dump(dict(info), f, indent=4)
-    num = 0
-    result = ""
-    amount = len([i for i in info.get('entries', []) if i.get('url')])
-    for entry in info.get('entries', []):
-        # title = entry.get('title', 'Untitled')
-        title = "%(title)s"
-        vid_url = entry.get('url', '')
-        if vid_url:
-            num += 1
-            ftype = "audio" if "music.youtube.com" in vid_url else "video"
-            zeros = len(str(amount)) - len(str(num))
-            title = f"{'0'*zeros}{num}.{title}"
-            result += f"{ftype} ; {vid_url} ; {title}\n"
+    import yt_dlp
+    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    info = ydl.extract_info(url, download=False, process=False)
+    while info.get('_type') in ('url', 'url_transparent'):
+        info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
     
     now = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime(time.time()))
     name = info.get("title", f"Playlist-{now}")
     
-    return name, result
+    return name, iter_playlist(ydl, info, metadata)
 
 
-def download_item(item: dict, catalogue: str = "", context: Context = None) -> None:
+def iter_playlist(ydl: "yt_dlp.YoutubeDL", info: dict, metadata: MetadataStore = None) -> Iterator[dict]:
+    entries = info.get('entries') or []
+    if isinstance(entries, list):
+        amount = len([i for i in entries if i and i.get('url')])
+    else:
+        amount = info.get('playlist_count')
+        if not amount:
+            # number width is unknown until the whole playlist is paginated
+            entries = list(entries)
+            amount = len([i for i in entries if i and i.get('url')])
+    dumped = []
+    num = 0
+    with ydl:
+        for entry in entries:
+            if not entry:
+                continue
+            if metadata:
+                metadata.add("entry", entry, playlist=info.get('id'))
+                if metadata.dump_enabled:
+                    dumped.append(entry)
+            # title = entry.get('title', 'Untitled')
+            title = "%(title)s"
+            vid_url = entry.get('url', '')
+            if vid_url:
+                num += 1
+                ftype = "audio" if "music.youtube.com" in vid_url else "video"
+                zeros = len(str(amount)) - len(str(num))
+                title = f"{'0'*zeros}{num}.{title}"
+                yield {
+                    'type': ftype,
+                    'filename': title,
+                    'url': vid_url,
+                    'id': entry.get('id'),
+                    'extractor': entry.get('ie_key'),
+                    # for the download plan
+                    'duration': entry.get('duration'),
+                    'filesize': entry.get('filesize') or entry.get('filesize_approx'),
+                }
+        if metadata:
+            metadata.add("playlist", info, count=num)
+            if metadata.dump_enabled:
+                metadata.dump(
+                    f"playlist_{info.get('id') or int(time.time())}",
+                    ydl.sanitize_info({**info, 'entries': dumped}),
+                )
+
+
+def journal_event(context: Context, event: str, item: dict, **data) -> None:
+    if context.journal is not None:
+        context.journal.record(event, item, **data)
+
+
+def get_throttle(context: Context) -> Throttle:
+    """ Bandwidth cap and adaptive concurrency shared by everything using context """
+    if context.throttle is None:
+        context.throttle = Throttle(
+            context.rate_limit, context.workers, context.postprocess_workers, context.host_limits,
+        )
+    return context.throttle
+
+
+def get_cookie_store(context: Context) -> CookieStore:
+    """ Browser cookies shared by everything using context """
+    if context.cookie_store is None or context.cookie_store.browser != context.cookies:
+        context.cookie_store = CookieStore(context.cookies, cfg.COOKIES_TTL)
+    return context.cookie_store
+
+
+def build_youtube_dl(opts: dict, context: Context) -> tuple:
+    """ (YoutubeDL, its list of progress hooks) for ydl_pool. The hooks of
+    the current item are swapped in the list, yt-dlp keeps the ones it was
+    built with """
+    import yt_dlp
+    hooks = []
+
+    def dispatch(d: dict) -> None:
+        for hook in hooks:
+            hook(d)
+
+    ydl = yt_dlp.YoutubeDL({**opts, 'outtmpl': dict(opts['outtmpl']), 'progress_hooks': [dispatch]})
+    if context.cookies:
+        # instead of cookiesfrombrowser, which decrypts the browser database every time
+        ydl.__dict__['cookiejar'] = get_cookie_store(context).jar()[0]
+    return ydl, hooks
+
+
+def link_from_store(
+    item: dict,
+    opts: dict,
+    outtmpl: str,
+    result: DownloadResult,
+    context: Context,
+) -> bool:
+    """ Finishes result with a link to the same video and profile saved
+    into another directory, instead of downloading it again """
+    key = get_item_key(item)
+    if not key:
+        return False
+    profile = item_profile(item, context)
+    index = archive.get_index(cfg.ARCHIVE_FILE)
+    record = index.find(*key, profile)
+    if record is None:
+        return False
+    ext = os.path.splitext(record['path'])[1].lstrip('.')
+    info = {'id': key[1], 'extractor_key': key[0], 'title': record['title'] or key[1], 'ext': ext}
+    generation = get_cookie_store(context).ensure() if context.cookies else 0
+    with ydl_pool.checkout(
+        (opts['format'], context.cookies), lambda: build_youtube_dl(opts, context), generation
+    ) as (ydl, hooks):
+        # the name a download would get, from the title of the stored one
+        ydl.params['outtmpl']['default'] = outtmpl
+        target = ydl.prepare_filename(info)
+    base = os.path.splitext(target)[0]
+    if base.lower().endswith(f".{ext}"):
+        target = base
+    if os.path.exists(target):
+        return False
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    result.linked = link_file(record['path'], target)
+    result.status = "done"
+    result.path = target
+    result.bytes = os.path.getsize(target)
+    index.add(*key, profile, target, record['format'], record['title'])
+    journal_event(context, "done", item, path=target)
+    logging.info(f"Linked '{os.path.basename(target)}' from {record['path']} ({result.linked})")
+    return True
+
+
+def download_formats(ydl: "yt_dlp.YoutubeDL", info: dict, outtmpl: str) -> dict:
+    """ Downloads the formats of a merged selection to their own files like
+    yt-dlp does, but leaves merging them to the post-processing pass instead
+    of its merger, which would rewrite the whole video once more. filepath
+    is the name yt-dlp would merge to, parts the downloaded files """
+    target = ydl.prepare_filename(info)
+    parts = []
+    try:
+        ydl.params['outtmpl']['default'] = outtmpl[:-len('.%(ext)s')] + '.f%(format_id)s.%(ext)s'
+        for fmt in info['requested_formats']:
+            part = {**info, **fmt}
+            part.pop('requested_formats')
+            part.pop('requested_downloads', None)
+            ydl.process_info(part)
+            if not part.get('filepath'):
+                raise ValueError(f"Format {fmt.get('format_id')} was not downloaded")
+            parts.append(part)
+    finally:
+        ydl.params['outtmpl']['default'] = outtmpl
+    # the video stream is taken from the first one
+    parts.sort(key=lambda part: part.get('vcodec') in (None, 'none'))
+    return {**info, 'filepath': target, 'parts': [part['filepath'] for part in parts]}
+
+
+def download_item(
+    item: dict,
+    catalogue: str = "",
+    context: Context = None,
+    postprocess: bool = True,
+) -> DownloadResult:
+    """ Network stage of an item. With postprocess=False the result is left
+    in "downloaded" status for postprocess_item """
     if not context:
         context = Context()
     if "instagram.com/reel/" in item['filename']:
@@ -215,8 +647,9 @@ def download_item(item: dict, catalogue: str = "", context: Context = None) -> N
     ):
         catalogue_processed = catalogue_processed[8:].strip()
     
+    outtmpl = f"{context.output}/" + catalogue + fn + '.%(ext)s'
     opts = {
-        'outtmpl': f"{context.output}/" + catalogue + fn + '.%(ext)s',
+        'outtmpl': {'default': outtmpl},
         'noplaylist': True,
         # 'quiet': True,
         'no_warnings': True,
@@ -225,127 +658,609 @@ def download_item(item: dict, catalogue: str = "", context: Context = None) -> N
         'retries': 1,
         'fragment_retries': 3,
         'concurrent_fragment_downloads': 4,
-        'postprocessors': []
+        # .part files of an interrupted run are continued
+        'continuedl': True,
     }
 
-    if context.cookies:
-        opts['cookiesfrombrowser'] = (context.cookies,)
-
-    is_audio = item['type'] == 'audio'
-
-    if is_audio:
+    if item['type'] == 'audio':
         opts['format'] = 'bestaudio/best'
-        opts['postprocessors'].append(
-            {
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '320',
-            }
-        )
     else:    # video
         opts['format'] = 'bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]'
-        opts['postprocessors'].append(
-            {
-                'key': 'FFmpegVideoRemuxer',
-                'preferedformat': 'mp4',
-            }
-        )
-
-    opts['postprocessors'].append({'key': 'FFmpegMetadata'})
+        # the post-processing pass remuxes every download, yt-dlp fixups
+        # would only rewrite the file once more before it
+        opts['fixup'] = 'never'
 
+    result = DownloadResult(item)
+    throttle = get_throttle(context)
+    host = throttle.hosts.key(item['url'])
+    progress = {'bytes': 0, 'started': time.time(), 'slow': False}
     name_list = [None]
     def filename_hook(d):
+        if d['status'] == 'downloading':
+            progress['partial'] = d.get('tmpfilename')
+            downloaded = d.get('downloaded_bytes') or 0
+            if downloaded > progress['bytes']:
+                throttle.on_bytes(downloaded - progress['bytes'])
+            progress['bytes'] = downloaded
+            speed = d.get('speed')
+            if (
+                speed is not None
+                and not progress['slow']
+                and time.time() - progress['started'] > 5
+                and throttle.is_slow(speed)
+            ):
+                progress['slow'] = True
+                throttle.on_throttled(f"{speed / 1024:.0f} KiB/s", host)
+        if d['status'] == 'finished':
+            progress['bytes'] = 0
+            # called once per format when video and audio are merged
+            result.downloaded_bytes += d.get('total_bytes') or d.get('downloaded_bytes') or 0
         if d['status'] == 'finished' and name_list[0] is None:
             name_list[0] = d.get('info_dict', {}).get('_filename')
             if not name_list[0]:
                 name_list[0] = d.get('filename', "Unknown.webm")
 
-    opts['progress_hooks'] = [filename_hook]
+    if context.use_archive:
+        try:
+            if link_from_store(item, opts, outtmpl, result, context):
+                result.timings['total'] = time.time() - progress['started']
+                return result
+        except Exception as e:
+            logging.warning(f"Could not reuse a stored file for {item['url']}: {type(e).__name__} - {e}")
 
     logging.info(f"Downloading '{fn}'...")
 
+    key = get_item_key(item) if context.metadata_ttl > 0 else None
+    info = None
+    cookies_generation = None
+    started = time.time()
     try:
-        with yt_dlp.YoutubeDL(opts) as ydl:
+        if context.cookies:
+            cookies_generation = get_cookie_store(context).ensure()
+
+        def build():
+            return build_youtube_dl(opts, context)
+
+        pool_key = (opts['format'], context.cookies)
+        with ydl_pool.checkout(pool_key, build, cookies_generation or 0) as (ydl, hooks):
+            # per item settings of the pooled instance
+            ydl.params['outtmpl']['default'] = outtmpl
+            hooks[:] = [filename_hook]
             t1 = time.time()
-            info = ydl.extract_info(item['url'], download=False)
+            # put back if this attempt fails as well
+            info = metadata_cache.pop(key) if key else None
+            if info is None:
+                info = ydl.extract_info(item['url'], download=False)
+                if context.metadata_ttl > 0:
+                    key = (info['extractor_key'], info['id'])
+            else:
+                logging.debug(f"[{fn}] Using cached metadata for {key[1]}")
             t1 = time.time()-t1
-            with open(f"video_info.json", "w", encoding="utf-8") as f:
-                json.dump(info, f, indent=2)
+            result.timings['extract'] = t1
+            if context.metadata and context.metadata.dump_enabled:
+                # a copy, the writer thread gets to it while info is processed
+                context.metadata.dump(f"{info.get('extractor_key')}_{info.get('id')}", ydl.sanitize_info(info))
             t2 = time.time()
-            ydl.download(item['url'])
+            # download from the already extracted info instead of resolving the url again
+            if info.get('requested_formats'):
+                info = download_formats(ydl, info, outtmpl)
+            else:
+                info = ydl.process_ie_result(info, download=True)
             t2 = time.time()-t2
-            if not name_list[0]:
-                name_list[0] = "Unknown.idk"
-            final_filename = str(name_list[0].rsplit('.', 1)[0])
-            final_filename += ".mp3" if is_audio else ".mp4"
-            splt = final_filename.split('.')
-            if len(splt) > 2:
-                if splt[-1] == splt[-2]:
-                    old_fn = final_filename
-                    final_filename = '.'.join(splt[:-1])
-                    try:
-                        os.rename(old_fn, final_filename)
-                    except OSError as e:
-                        final_filename = old_fn
-            fn = final_filename.replace("\\", "/").split("/")[-1]
-            logging.debug(f"[{fn}] Info extract time {t1}s")
-            logging.debug(f"[{fn}] Downloading time {t2}s")
-            if (
-                is_audio 
-                and "youtube.com/" in item['url'] 
-                and "thumbnail" in info 
-                and info["thumbnail"]
-            ):
-                logging.debug(f"[{fn}] Attaching thumbnail to audio {info["thumbnail"]}")
-                add_square_thumbnail_to_audio(fn, info["thumbnail"])
-            
-        logging.info(f"Download complete '{fn}'")
+            result.timings['download'] = t2
+            hooks.clear()
+        info.update((info.get('requested_downloads') or [{}])[0])
+        if not info.get('filepath'):
+            info['filepath'] = name_list[0] or "Unknown.idk"
+        if context.metadata:
+            context.metadata.add("video", info, path=info['filepath'])
+        logging.debug(f"[{fn}] Info extract time {t1}s")
+        logging.debug(f"[{fn}] Downloading time {t2}s")
+        result.status = "downloaded"
+        result.pending = info
+        journal_event(context, "downloaded", item, path=info['filepath'])
+        if not progress['slow']:
+            throttle.on_success(host)
     except Exception as e:
+        if is_throttle_error(e):
+            throttle.on_throttled("HTTP 429", host)
+        result.error = type(e).__name__
+        result.message = str(e)
+        result.transient = is_transient(e)
+        if cookies_generation and is_auth_error(e):
+            # retried if there are fresher cookies for the next attempt
+            result.transient = get_cookie_store(context).refresh(cookies_generation)
+        if key and info is not None and result.transient and "HTTP Error 403" not in str(e):
+            # processed info can be downloaded again like a --load-info-json
+            # file, except when signed format urls have probably expired
+            metadata_cache.set(key, info, context.metadata_ttl)
+        result.partial = progress.get('partial')
         logging.error(f"Download {item['filename']} ({item['url']}) failed")
         logging.error(f"{type(e)} - {e}")
+    result.timings['total'] = time.time() - started
+    if postprocess and result.status == "downloaded":
+        result = postprocess_item(result, context)
+    return result
+
+
+@dataclass
+class PostprocessPlan:
+    """ Everything ffmpeg has to do with a downloaded file, run as one pass """
+    source: str
+    target: str
+    streams: str  # ffmpeg map of the source streams to keep
+    codec_args: list[str]
+    metadata: dict
+    cover: Path = None  # image, or a vorbis_picture file for Ogg targets
+    audio_source: str = None  # audio downloaded apart from the video, merged by this pass
+
+    @property
+    def ogg(self) -> bool:
+        return os.path.splitext(self.target)[1].lstrip('.') in OGG_EXTENSIONS
+
+    @property
+    def temp_path(self) -> str:
+        return f"{self.target}.temp{os.path.splitext(self.target)[1]}"
+
+    def command(self, output: str) -> list[str]:
+        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-i", self.source]
+        if self.audio_source:
+            cmd += ["-i", self.audio_source]
+        if self.cover:
+            cmd += ["-i", str(self.cover)]
+        cmd += ["-map", self.streams]
+        if self.audio_source:
+            cmd += ["-map", "1:a"]
+        cmd += ["-map_metadata", "0"]
+        if self.cover:
+            cmd += cover_args(2 if self.audio_source else 1, self.ogg)
+        cmd += self.codec_args
+        for name, value in self.metadata.items():
+            cmd += ["-metadata", f"{name}={value}"]
+        cmd.append(output)
+        return cmd
 
 
-def manage_threads(items: list[dict], catalogue:str = "", context: Context = None) -> None:
-    items = items.copy()
-    threads = []
-    while threads or items:
-        remove_finished_threads(threads)
-        for item in items.copy():
-            if len(threads) < cfg.MAX_THREADS:
-                threads.append(Thread(target=download_item, args=(item, catalogue, context, )))
-                threads[-1].start()
-                items.remove(item)
-        time.sleep(1)
+def get_metadata(info: dict) -> dict:
+    """ Tags written to the output file, similar to yt-dlp FFmpegMetadata """
+    artists = info.get('artists') or info.get('creators')
+    metadata = {
+        'title': info.get('track') or info.get('title'),
+        'artist': ", ".join(artists) if artists else info.get('artist') or info.get('uploader'),
+        'album': info.get('album'),
+        'album_artist': info.get('album_artist'),
+        'track': info.get('track_number'),
+        'genre': info.get('genre'),
+        'date': info.get('release_year') or info.get('upload_date'),
+        'description': info.get('description'),
+        'comment': info.get('webpage_url'),
+    }
+    return {k: str(v) for k, v in metadata.items() if v}
+
+
+def passthrough_codec(info: dict) -> tuple[str, list[str]] | None:
+    """ Container keeping the downloaded audio stream as is """
+    acodec = (info.get('acodec') or "").lower()
+    ext = (info.get('ext') or "").lower()
+    if acodec.startswith("opus"):
+        return "opus", ["-c:a", "copy"]
+    if acodec.startswith("vorbis"):
+        return "ogg", ["-c:a", "copy"]
+    if acodec.startswith("mp4a") or ext == "m4a":
+        return "m4a", ["-c:a", "copy"]
+    if acodec.startswith("mp3") or ext == "mp3":
+        return "mp3", ["-c:a", "copy", "-id3v2_version", "3"]
+    return None
+
+
+def plan_postprocess(info: dict, profile: str, cover: Path = None) -> PostprocessPlan:
+    """ profile is "video" or one of cfg.AUDIO_PROFILES """
+    source = info['filepath']
+    base, ext = os.path.splitext(source)
+    ext = ext.lstrip('.').lower()
+    is_audio = profile != "video"
+    if not is_audio:
+        # streams are only copied, video and audio downloaded apart are merged
+        target_ext, codec_args = "mp4", ["-c", "copy"]
+    elif profile == "passthrough" and passthrough_codec(info):
+        target_ext, codec_args = passthrough_codec(info)
+    else:
+        if profile == "passthrough":
+            logging.debug(f"No passthrough container for {info.get('acodec')}, using mp3")
+            profile = cfg.DEFAULT_AUDIO_PROFILE
+        target_ext, codec_args = AUDIO_CODECS[profile]
+    # templates ending with the extension would give "name.mp3.mp3"
+    if base.lower().endswith(f".{target_ext}"):
+        base = base[:-len(target_ext) - 1]
+    # separately downloaded formats (see download_formats) are merged here
+    parts = info.get('parts') if not is_audio else None
+    return PostprocessPlan(
+        source=parts[0] if parts else source,
+        target=f"{base}.{target_ext}",
+        streams="0:a:0" if is_audio else "0:v" if parts else "0",
+        codec_args=codec_args,
+        metadata=get_metadata(info),
+        cover=cover if is_audio else None,
+        audio_source=parts[1] if parts and len(parts) > 1 else None,
+    )
 
 
-def main(inp: str, context: Context = None) -> None:
+def run_postprocess(plan: PostprocessPlan) -> str:
+    """ Single ffmpeg pass writing plan.target, the source is removed afterwards """
+    temp_path = plan.temp_path
+    try:
+        run_ffmpeg(plan.command(temp_path))
+        os.replace(temp_path, plan.target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    for source in (plan.source, plan.audio_source):
+        if source and os.path.abspath(source) != os.path.abspath(plan.target):
+            try:
+                os.remove(source)
+            except OSError:
+                pass
+    return plan.target
+
+
+def postprocess_item(result: DownloadResult, context: Context = None) -> DownloadResult:
+    """ ffmpeg stage of a downloaded item: conversion, metadata and cover """
     if not context:
         context = Context()
+    item = result.item
+    info = result.pending
+    result.pending = None
+    is_audio = item['type'] == 'audio'
+    profile = (item.get('profile') or context.audio_profile) if is_audio else "video"
+    started = time.time()
+    try:
+        cover = None
+        if (
+            is_audio 
+            and "youtube.com/" in item['url'] 
+            and "thumbnail" in info 
+            and info["thumbnail"]
+        ):
+            t3 = time.time()
+            cover = get_cover(info["thumbnail"])
+            result.timings['thumbnail'] = time.time()-t3
+        plan = plan_postprocess(info, profile, cover)
+        if plan.cover and plan.ogg:
+            plan.cover = vorbis_picture(plan.cover)
+        fn = plan.target.replace("\\", "/").split("/")[-1]
+        logging.debug(f"[{fn}] Post-processing {plan.source} (cover: {cover is not None})")
+        journal_event(context, "postprocess", item, temp=plan.temp_path)
+        t4 = time.time()
+        final_filename = run_postprocess(plan)
+        result.timings['postprocess'] = time.time()-t4
+        logging.debug(f"[{fn}] Post-processing time {result.timings['postprocess']}s")
+        result.status = "done"
+        result.path = final_filename
+        result.bytes = os.path.getsize(final_filename)
+        if context.use_archive:
+            archive.get_index(cfg.ARCHIVE_FILE).add(
+                info['extractor_key'], info['id'], item_profile(item, context),
+                final_filename, info.get('format_id'), info.get('title'),
+            )
+        journal_event(context, "done", item, path=final_filename)
+        logging.info(f"Download complete '{fn}'")
+    except Exception as e:
+        result.status = "failed"
+        result.error = type(e).__name__
+        result.message = str(e)
+        result.transient = is_transient(e)
+        logging.error(f"Post-processing {item['filename']} ({item['url']}) failed")
+        logging.error(f"{type(e)} - {e}")
+    result.timings['total'] += time.time() - started
+    return result
+
+
+def task_result(task: Task) -> DownloadResult:
+    """ DownloadResult of a pool task, also if download_item itself raised """
+    if task.ok and isinstance(task.result, DownloadResult):
+        return task.result
+    item = task.args[0]
+    result = DownloadResult(item)
+    if isinstance(item, DownloadResult):
+        result = DownloadResult(item.item, attempts=item.attempts, timings=item.timings)
+    if task.error is not None:
+        result.error = type(task.error).__name__
+        result.message = str(task.error)
+    return result
+
+
+def split_results(results: list[DownloadResult]) -> tuple[list[DownloadResult], list[DownloadResult]]:
+    done, failed = [], []
+    for result in results:
+        if result.status == "done":
+            done.append(result)
+        else:
+            failed.append(result)
+    return done, failed
+
+
+def worker_speed(context: Context) -> float:
+    """ Bytes per second a download is assumed to get """
+    if context.rate_limit:
+        return min(cfg.PLAN_WORKER_SPEED, context.rate_limit / max(1, context.workers))
+    return cfg.PLAN_WORKER_SPEED
+
+
+def item_cost(item: dict, context: Context) -> plan.Estimate:
+    """ Estimate from cached metadata or the flat playlist fields, without requests """
+    info = None
+    if item.get('extractor') and item.get('id'):
+        info = metadata_cache.get((item['extractor'], item['id']))
+    return plan.estimate(item, info, worker_speed(context))
+
+
+def get_link_restorer() -> LinkRestorer:
+    """ Restored youtube music links shared by every run, loaded on first use """
+    global _link_restorer
+    with _link_restorer_lock:
+        if _link_restorer is None:
+            _link_restorer = LinkRestorer(cfg.RESTORE_CACHE_FILE)
+        return _link_restorer
+
+
+def restore_music_link(item: dict) -> dict:
+    """ Copy of an audio item with the url youtube music gives for it now """
+    item = item.copy()
+    logging.info(f"Restoring link for {item['url']}...")
+    restored_url = get_link_restorer().restore(item['url'])
+    if not restored_url:
+        logging.warning(f"Url restore failed for {item['url']}")
+    elif restored_url == item['url']:
+        logging.debug(f"Restore returned same url {restored_url}")
+    else:
+        logging.info(f"Restored {item['url']} -> {restored_url}")
+        item['url'] = restored_url
+    return item
+
+
+def manage_threads(
+    items: Iterable[dict],
+    catalogue: str = "",
+    context: Context = None,
+    on_done: callable = None,
+    restore_links: bool = False,
+) -> list[DownloadResult]:
+    """ Downloads run on context.workers threads and hand finished files over
+    to a post-processing pool sized to the cpu count through a bounded queue,
+    so transcoding overlaps with the next downloads.
+    Every host has its own slots and spacing (see throttle.HostLimits).
+    Items are started longest first (see item_cost) among the queued ones,
+    so long videos do not start last and keep the run waiting on them.
+    Attempts failed with a transient error go back to the download pool after
+    an exponential backoff, up to cfg.RETRY_ATTEMPTS per item. With
+    restore_links audio items get their youtube music link restored first,
+    the restore runs on its own pool while the retry waits for the backoff.
+    on_done(result) is called after every attempt, result.retry is set when
+    another one follows. Returns the final result of every item """
+    if not context:
+        context = Context()
+    ydl_pool.reserve(context.workers)
+    results = []
+    cond = threading.Condition()
+    unfinished = 0
+
+    def needs_restore(item: dict) -> bool:
+        return item['type'] == 'audio' and (
+            restore_links or "://music.youtube.com/" in item['url']
+        )
+
+    def fetch(item: dict, attempt: int) -> DownloadResult:
+        if attempt > 1 and needs_restore(item):
+            item = restore_music_link(item)
+        journal_event(context, "started", item, attempt=attempt)
+        return download_item(item, catalogue + item.get('catalogue', ""), context, False)
+
+    def finished(result: DownloadResult):
+        nonlocal unfinished
+        result.retry = (
+            result.status == "failed"
+            and result.transient
+            and result.attempts < cfg.RETRY_ATTEMPTS
+        )
+        try:
+            if on_done:
+                on_done(result)
+        finally:
+            if not result.retry and context.metadata_ttl > 0:
+                key = get_item_key(result.item)
+                if key:
+                    metadata_cache.pop(key)
+            if result.retry:
+                delay = backoff_delay(result.attempts)
+                logging.info(
+                    f"Retrying '{result.item.get('filename')}' in {delay:.1f}s "
+                    f"({result.attempts + 1}/{cfg.RETRY_ATTEMPTS}, {result.error})"
+                )
+                if needs_restore(result.item):
+                    get_link_restorer().prefetch([result.item['url']])
+                pool.submit(
+                    result.item, result.attempts + 1, delay=delay,
+                    priority=item_cost(result.item, context).seconds,
+                )
+            else:
+                if result.status == "failed":
+                    journal_event(
+                        context, "failed", result.item, error=result.error,
+                        permanent=not result.transient, partial=result.partial,
+                    )
+                with cond:
+                    results.append(result)
+                    unfinished -= 1
+                    cond.notify_all()
+
+    def postprocessed(task: Task):
+        result = task_result(task)
+        result.timings['postprocess_queue'] = task.started - task.queued
+        finished(result)
+
+    post_pool = WorkerPool(
+        postprocess_item,
+        context.postprocess_workers,
+        postprocessed,
+        "postprocess",
+        max_pending=context.postprocess_workers * 2,
+        limit=get_throttle(context).postprocess_limit,
+    )
+    def downloaded(task: Task):
+        result = task_result(task)
+        result.attempts = task.args[1]
+        result.timings['queue'] = task.started - task.queued
+        if result.status == "downloaded":
+            # blocks while the post-processing queue is full
+            post_pool.submit(result, context)
+        else:
+            finished(result)
+
+    hosts = get_throttle(context).hosts
+    pool = WorkerPool(
+        fetch,
+        context.workers,
+        downloaded,
+        "download",
+        limit=get_throttle(context).limit,
+        # a host out of slots does not hold up items of the others
+        groups=hosts,
+        group_of=lambda item, attempt: hosts.key(item['url']),
+    )
+    def wait_unfinished():
+        # retries of failed items are submitted from the pools themselves
+        with cond:
+            while unfinished:
+                cond.wait()
+
+    with post_pool, pool:
+        try:
+            try:
+                for item in items:
+                    with cond:
+                        unfinished += 1
+                    pool.submit(item, 1, priority=item_cost(item, context).seconds)
+            except Exception:
+                # items queued before the error still finish
+                wait_unfinished()
+                raise
+            wait_unfinished()
+        except KeyboardInterrupt:
+            # the journal has what is left, do not wait for the queue
+            pool.cancel()
+            post_pool.cancel()
+            raise
+    return results
+
+
+def url_entry(url: str) -> str:
+    """ Input line for a single url, youtube music links are saved as audio """
+    if "//music.youtube.com/" in url:
+        return f"audio ; {url} ; %(title)s"
+    return f"video ; {url} ; %(title)s"
+
+
+def main(inp: str, context: Context = None, input_file: str = 'input.txt') -> None:
+    if not context:
+        context = Context()
+    metadata = MetadataStore(
+        os.path.join(cfg.METRICS_DIR, f"metadata_{int(time.time()*1000)}"),
+        dump=context.dump_info,
+    )
+    context.metadata = metadata
+    try:
+        process_input(inp, context, input_file)
+    finally:
+        context.metadata = None
+        metadata.close()
+
+
+def plan_input(inp: str, context: Context, input_file: str = 'input.txt') -> None:
+    """ Dry run logging the estimated size and duration of an input """
+    playlist = ""
+    try:
+        if inp == "file":
+            items = read_input_file(input_file, context)
+        elif inp.startswith("http") and "/playlist" in inp:
+            name, items = get_playlist(inp, context.metadata)
+            playlist = f"{name}/"
+        else:
+            items = parse_items((url_entry(inp) if inp.startswith("http") else inp).split("\n"))
+    except Exception as e:
+        logging.debug(f"{type(e)} - {e}")
+        logging.error("Invalid input")
+        print(cfg.INPUT_ERROR_MESSAGE)
+        return
+    skipped = []
+    items = list(filter_archived(items, f"{context.output}/{playlist}", context, skipped))
+    estimates = [item_cost(item, context) for item in items]
+    costs = [estimate.seconds for estimate in estimates]
+    total = sum(estimate.bytes for estimate in estimates)
+    logging.info(
+        f"Plan for {len(items)} items on {context.workers} workers"
+        + (f", {len(skipped)} already downloaded" if skipped else "")
+    )
+    logging.info(
+        f"Estimated size {total / 2**30:.2f} GiB, "
+        f"{len([e for e in estimates if e.known])} items with a known duration or size"
+    )
+    logging.info(
+        f"Estimated time {plan.format_duration(plan.makespan(sorted(costs, reverse=True), context.workers))} "
+        f"longest first, {plan.format_duration(plan.makespan(costs, context.workers))} in input order"
+    )
+    if estimates:
+        longest = max(range(len(items)), key=lambda i: costs[i])
+        logging.info(
+            f"Longest: {items[longest]['url']} ({estimates[longest].bytes / 2**20:.0f} MiB, "
+            f"{plan.format_duration(costs[longest])})"
+        )
+
+
+def process_input(inp: str, context: Context, input_file: str = 'input.txt') -> None:
     if inp.lower().strip() == "exit":
         print("Exiting...")
         context.single_input = True
         return
     context.output = context.output.replace('\\', '/').rstrip('/')
+    if context.plan_only:
+        plan_input(inp, context, input_file)
+        return
     os.makedirs(context.output, exist_ok=True)
     playlist = ""
+    if inp == "file" or (inp.startswith("http") and "/playlist" in inp):
+        source = f"file:{os.path.abspath(input_file)}" if inp == "file" else inp
+        journal = Journal(journal_path(source, context.output))
+        if journal.resumed:
+            logging.info(
+                f"Resuming unfinished run, {len(journal.unfinished())} "
+                f"of {len(journal.items)} queued items left"
+            )
+            journal.collect_garbage()
+    input_errors = []
     if inp == "file":
-        with open('input.txt') as f:
-            lines = f.readlines()
+        items = read_input_file(input_file, context, input_errors)
+        journal.start(inp)
     elif inp.startswith("http") and "/playlist" in inp:
-        name, lines = get_playlist(inp)
-        lines = lines.split("\n")
+        if journal.complete:
+            # every item was queued before, no need to paginate again
+            name, items = journal.playlist, journal.unfinished()
+            logging.info(f"Continuing playlist '{name}' from the journal")
+        else:
+            name, items = get_playlist(inp, context.metadata)
+            logging.info(f"Expanding playlist '{name}'")
         playlist = f"{name}/"
+        journal.start(inp, name)
     else:
         if inp.startswith("http"):
-            if "//music.youtube.com/" in inp:
-                inp = f"audio ; {inp} ; %(title)s"
-            else:
-                inp = f"video ; {inp} ; %(title)s"
+            inp = url_entry(inp)
 
         try:
             items = parse_items(inp.split("\n"))
             if not items:
                 raise ValueError("Can not parse any items")
+            if not list(filter_archived(items[:1], context.output, context)):
+                logging.info(f"Already downloaded '{items[0]['url']}'")
+                return
             download_item(items[0], "", context)
         except Exception as e:
             logging.debug(f"{type(e)} - {e}")
@@ -353,62 +1268,60 @@ def main(inp: str, context: Context = None) -> None:
             print(cfg.INPUT_ERROR_MESSAGE)
         return
     
-    logging.info(f"Read {len(lines)} lines")
-
-    items = parse_items(lines)
-    logging.info(f"Parsed {len(items)} items")
+    skipped = []
+    items = filter_archived(items, f"{context.output}/{playlist}", context, skipped)
+    items = journal.queue(items, skipped)
+    context.journal = journal
+    metrics = RunMetrics(os.path.join(cfg.METRICS_DIR, f"metrics_{int(time.time()*1000)}"))
     
-    beginning = time.time()
-    manage_threads(items, playlist, context)
-    new_files = [
-        f for f in os.listdir(f"{context.output}/{playlist}")
-        if not os.path.isdir(f"{context.output}/{playlist}{f}")
-        and os.path.getmtime(os.path.join(f"{context.output}/{playlist}", f)) > beginning
-    ]
-    for f in new_files:
-        if f.endswith(".mp3.temp.mp3"):
-            os.remove(os.path.join(f"{context.output}/{playlist}", f))
-
-    for i in range(4):
-        new_files = [
-            f for f in os.listdir(f"{context.output}/{playlist}")
-            if not os.path.isdir(f"{context.output}/{playlist}{f}")
-            and os.path.getmtime(os.path.join(f"{context.output}/{playlist}", f)) > beginning
-        ]
-        logging.info(f"Done {len(new_files)}/{len(items)}")
-        if len(new_files) == len(items):
-            return
-        
-        failed = []
-        logging.info(f"Failed:")
-        for item in items:
-            for fn in new_files:
-                if fn.split('.')[0] == item.get("filename", "").split('.')[0]:
-                    break
-            else:
-                failed.append(item.copy())
-                logging.info(item.get("filename", "Unknown"))
-        
-        if i == 3:
-            return
-
-        logging.info(f"Retrying failed items ({i+1}/3):")
-
-        for item in failed:
-            if item['type'] == 'audio' and (
-                "://music.youtube.com/" in item['url']
-                or "://music.youtube.com/" in inp
-            ):
-                logging.info(f"Restoring link for {item['url']}...")
-                restored_url = ytmusic_restore_link(item['url'])
-                if not restored_url:
-                    logging.warning(f"Url restore failed for {item['url']}")
-                elif restored_url == item['url']:
-                    logging.debug(f"Restore returned same url {restored_url}")
-                else:
-                    logging.info(f"Restored {item['url']} -> {restored_url}")
-                    item['url'] = restored_url
-            download_item(item, playlist, context)
+    finished = itertools.count(1)
+    def progress_hook(result: DownloadResult):
+        metrics.record(result)
+        if context.on_result:
+            context.on_result(result)
+        if not result.retry:
+            logging.info(f"Finished {next(finished)} ({result.timings.get('total', 0):.1f}s)")
+
+    done, failed = [], []
+    try:
+        done, failed = split_results(manage_threads(
+            items, playlist, context, progress_hook,
+            restore_links="://music.youtube.com/" in inp,
+        ))
+        logging.debug(f"HTTP pool stats: {net.stats()}")
+        logging.debug(f"YoutubeDL pool stats: {ydl_pool.stats()}")
+        if skipped:
+            logging.info(f"Skipped {len(skipped)} already downloaded items")
+        if context.use_archive and (done or failed):
+            linked = len([result for result in done if result.linked])
+            store = archive.get_index(cfg.ARCHIVE_FILE).store_stats()
+            logging.info(
+                f"Content store: {linked}/{len(done) + len(failed)} items linked "
+                f"({linked / (len(done) + len(failed)):.0%} hit rate), "
+                f"{store['files']} files, {store['bytes'] / 2**20:.1f} MiB"
+            )
+        if done or failed:
+            logging.info(f"Done {len(done)}/{len(done) + len(failed)}")
+        if failed:
+            logging.info(f"Failed:")
+            for result in failed:
+                reason = f"{result.attempts} attempts" if result.transient else "permanent"
+                logging.info(f"{result.item.get('filename', 'Unknown')} ({result.error}, {reason})")
+        if input_errors:
+            logging.info(f"Invalid lines of {input_file}:")
+            for number, reason in sorted(input_errors)[:20]:
+                logging.info(f"line {number}: {reason}")
+            if len(input_errors) > 20:
+                logging.info(f"... and {len(input_errors) - 20} more")
+        journal.finish()
+    finally:
+        context.journal = None
+        journal.close()
+        summary = metrics.finish(len(done), len(failed))
+        logging.info(
+            f"{summary['items_per_second']} items/s, "
+            f"metrics were saved to {metrics.path}.jsonl and {metrics.path}.prom"
+        )
 
 
 if __name__ == "__main__":
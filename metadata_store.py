@@ -0,0 +1,89 @@
+## metadata of a run kept as JSON lines written by one thread
+import os
+import cfg
+import json
+import time
+import queue
+import logging
+import threading
+
+
+def summarize(info: dict) -> dict:
+    """ Fields of an extract_info result that are worth keeping """
+    return {
+        'id': info.get('id'),
+        'extractor': info.get('extractor_key') or info.get('ie_key'),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail'),
+        'format': info.get('format_id'),
+        'filesize': info.get('filesize') or info.get('filesize_approx'),
+        'url': info.get('webpage_url') or info.get('url'),
+    }
+
+
+class MetadataStore:
+    """ Appends a line per record to <path>.jsonl. Workers only put records
+    on a queue, a single writer thread writes them in batches of up to
+    cfg.METADATA_BATCH_SIZE or every cfg.METADATA_FLUSH_INTERVAL seconds.
+    With dump, full info dicts also go to cfg.INFO_DUMP_DIR, one file each.
+    Files are created with the first record """
+
+    def __init__(self, path: str, dump: bool = False):
+        self.path = f"{path}.jsonl"
+        self.dump_enabled = dump
+        self.queue = queue.Queue()
+        self.file = None
+        self.written = 0
+        self.thread = threading.Thread(target=self._writer, name="metadata", daemon=True)
+        self.thread.start()
+
+    def add(self, kind: str, info: dict, **data) -> None:
+        self.queue.put(('record', {'type': kind, **summarize(info), **data, 'time': round(time.time(), 3)}))
+
+    def dump(self, name: str, info: dict) -> None:
+        """ Full info as <name>.json if dumps are enabled """
+        if self.dump_enabled:
+            self.queue.put(('dump', (name, info)))
+
+    def _writer(self) -> None:
+        closing = False
+        while not closing:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + cfg.METADATA_FLUSH_INTERVAL
+            while len(batch) < cfg.METADATA_BATCH_SIZE and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            closing = batch[-1] is None
+            try:
+                self._write([entry for entry in batch if entry is not None])
+            except Exception as e:
+                logging.warning(f"Could not write metadata: {type(e).__name__} - {e}")
+
+    def _write(self, batch: list[tuple]) -> None:
+        lines = []
+        for kind, data in batch:
+            if kind == 'record':
+                lines.append(json.dumps(data, ensure_ascii=False))
+                continue
+            name, info = data
+            os.makedirs(cfg.INFO_DUMP_DIR, exist_ok=True)
+            with open(os.path.join(cfg.INFO_DUMP_DIR, f"{name}.json"), "w", encoding="utf-8") as f:
+                json.dump(info, f, indent=2, default=str)
+        if not lines:
+            return
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write("\n".join(lines) + "\n")
+        self.file.flush()
+        self.written += len(lines)
+
+    def close(self) -> None:
+        """ Writes what is queued and stops the writer """
+        self.queue.put(None)
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,131 @@
+## per-item phase timings and run level aggregates
+import os
+import json
+import math
+import time
+import threading
+
+
+PHASES = ("queue", "extract", "download", "postprocess_queue", "thumbnail", "postprocess", "total")
+
+
+def percentile(values: list[float], q: float) -> float:
+    """ Nearest-rank percentile, values must be sorted """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(q * len(values)) - 1))
+    return values[index]
+
+
+class RunMetrics:
+    """ Appends one JSON line per finished attempt to <path>.jsonl and writes
+    run aggregates to the same file and as a Prometheus text snapshot to
+    <path>.prom on finish() """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.started = time.time()
+        self.records = []
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(f"{path}.jsonl", "a", encoding="utf-8")
+
+    def record(self, result) -> None:
+        download = result.timings.get("download") or 0
+        record = {
+            'type': "item",
+            'time': time.time(),
+            'url': result.item.get('url'),
+            'status': result.status,
+            'attempt': result.attempts,
+            'error': result.error,
+            'bytes': result.bytes,
+            'downloaded_bytes': result.downloaded_bytes,
+            'linked': result.linked,
+            'bandwidth': result.downloaded_bytes / download if download else None,
+            'timings': {k: round(v, 4) for k, v in result.timings.items()},
+        }
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            self.records.append(record)
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def summary(self, done: int, failed: int) -> dict:
+        """ done and failed are final item counts, records are per attempt """
+        with self.lock:
+            records = list(self.records)
+        elapsed = max(time.time() - self.started, 1e-9)
+        phases = {}
+        for phase in PHASES:
+            values = sorted(r['timings'][phase] for r in records if phase in r['timings'])
+            if values:
+                phases[phase] = {
+                    'count': len(values),
+                    'sum': round(sum(values), 4),
+                    'p50': percentile(values, 0.5),
+                    'p95': percentile(values, 0.95),
+                }
+        bandwidth = sorted(r['bandwidth'] for r in records if r['bandwidth'])
+        return {
+            'type': "summary",
+            'elapsed': round(elapsed, 3),
+            'items': done + failed,
+            'done': done,
+            'failed': failed,
+            'attempts': len(records),
+            'retries': len([r for r in records if r['attempt'] > 1]),
+            'items_per_second': round(done / elapsed, 4),
+            'bytes': sum(r['bytes'] or 0 for r in records if r['status'] == "done"),
+            'downloaded_bytes': sum(r['downloaded_bytes'] or 0 for r in records),
+            'linked': len([r for r in records if r['linked']]),
+            'bandwidth_p50': percentile(bandwidth, 0.5),
+            'bandwidth_p95': percentile(bandwidth, 0.95),
+            'phases': phases,
+        }
+
+    def prometheus(self, summary: dict) -> str:
+        lines = [
+            "# HELP ytpd_items Items by final status",
+            "# TYPE ytpd_items gauge",
+            f'ytpd_items{{status="done"}} {summary["done"]}',
+            f'ytpd_items{{status="failed"}} {summary["failed"]}',
+            "# HELP ytpd_retries_total Retried download attempts",
+            "# TYPE ytpd_retries_total counter",
+            f"ytpd_retries_total {summary['retries']}",
+            "# HELP ytpd_items_per_second Finished items per second of the run",
+            "# TYPE ytpd_items_per_second gauge",
+            f"ytpd_items_per_second {summary['items_per_second']}",
+            "# HELP ytpd_bytes_total Size of finished files",
+            "# TYPE ytpd_bytes_total counter",
+            f"ytpd_bytes_total {summary['bytes']}",
+            "# HELP ytpd_downloaded_bytes_total Bytes downloaded by all attempts",
+            "# TYPE ytpd_downloaded_bytes_total counter",
+            f"ytpd_downloaded_bytes_total {summary['downloaded_bytes']}",
+            "# HELP ytpd_linked_items Items linked from the content store instead of downloaded",
+            "# TYPE ytpd_linked_items gauge",
+            f"ytpd_linked_items {summary['linked']}",
+            "# HELP ytpd_bandwidth_bytes_per_second Effective download bandwidth per item",
+            "# TYPE ytpd_bandwidth_bytes_per_second summary",
+            f'ytpd_bandwidth_bytes_per_second{{quantile="0.5"}} {summary["bandwidth_p50"]}',
+            f'ytpd_bandwidth_bytes_per_second{{quantile="0.95"}} {summary["bandwidth_p95"]}',
+            "# HELP ytpd_phase_seconds Duration of item phases",
+            "# TYPE ytpd_phase_seconds summary",
+        ]
+        for phase, values in summary['phases'].items():
+            lines += [
+                f'ytpd_phase_seconds{{phase="{phase}",quantile="0.5"}} {values["p50"]}',
+                f'ytpd_phase_seconds{{phase="{phase}",quantile="0.95"}} {values["p95"]}',
+                f'ytpd_phase_seconds_sum{{phase="{phase}"}} {values["sum"]}',
+                f'ytpd_phase_seconds_count{{phase="{phase}"}} {values["count"]}',
+            ]
+        return "\n".join(lines) + "\n"
+
+    def finish(self, done: int, failed: int) -> dict:
+        summary = self.summary(done, failed)
+        with self.lock:
+            self.file.write(json.dumps(summary) + "\n")
+            self.file.close()
+        with open(f"{self.path}.prom", "w", encoding="utf-8") as f:
+            f.write(self.prometheus(summary))
+        return summary
@@ -0,0 +1,143 @@
+## youtube music links restored on a bounded pool and cached across runs
+import os
+import cfg
+import net
+import json
+import time
+import logging
+import threading
+from pool import WorkerPool
+
+
+MARKER = "://music.youtube.com/watch?v="
+
+
+def read_restored_link(url: str) -> str | None:
+    """ First music.youtube.com watch link of the page, the response is
+    only read until it is found (or cfg.RESTORE_MAX_BYTES) """
+    with net.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        text = ""
+        read = 0
+        for chunk in resp.iter_content(16384):
+            read += len(chunk)
+            text += chunk.decode("utf-8", errors="ignore")
+            start = text.find(MARKER)
+            if start != -1:
+                end = text.find('"', start + len(MARKER))
+                if end != -1:
+                    return f"https://music.youtube.com/watch?v={text[start + len(MARKER):end]}"
+                # the id continues in the next chunk
+                text = text[start:]
+            else:
+                # a marker split between two chunks is kept
+                text = text[-len(MARKER):]
+            if read >= cfg.RESTORE_MAX_BYTES:
+                break
+    return None
+
+
+def ytmusic_restore_link(old_link: str) -> str | None:
+    """ None when the page has no watch link, network errors are raised """
+    if "youtube.com/watch?" not in old_link:
+        return None
+    url = old_link.split('youtube.com/watch?', 1)
+    url = "https://music.youtube.com/watch?" + url[1]
+    return read_restored_link(url)
+
+
+class LinkRestorer:
+    """ Original -> restored links, kept in a json file for cfg.RESTORE_CACHE_TTL
+    seconds and pages without one for cfg.RESTORE_NEGATIVE_TTL. Links are
+    resolved on a pool of cfg.RESTORE_WORKERS threads: prefetch() queues
+    the ones of retries while they wait for their backoff, restore() takes
+    the cached one, waits for one in flight or resolves it right away """
+
+    def __init__(self, path: str, workers: int = cfg.RESTORE_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.entries = {}  # original -> (restored or None, time)
+        self.in_flight = {}  # original -> threading.Event
+        self.pool = None
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = {url: tuple(entry) for url, entry in json.load(f).items()}
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _save(self) -> None:
+        """ Called with the lock held """
+        now = time.time()
+        entries = {url: entry for url, entry in self.entries.items() if not self._expired(entry, now)}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = f"{self.path}.temp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _expired(entry: tuple, now: float) -> bool:
+        restored, cached = entry
+        ttl = cfg.RESTORE_CACHE_TTL if restored else cfg.RESTORE_NEGATIVE_TTL
+        return now - cached > ttl
+
+    def cached(self, url: str) -> tuple[bool, str | None]:
+        """ (found, restored link or None for a cached failure) """
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is None or self._expired(entry, time.time()):
+            return False, None
+        return True, entry[0]
+
+    def _claim(self, url: str) -> threading.Event | None:
+        """ Event to wait for if url is resolved by another thread, None if
+        the caller has to resolve it """
+        with self.lock:
+            event = self.in_flight.get(url)
+            if event is None:
+                self.in_flight[url] = threading.Event()
+            return event
+
+    def _resolve(self, url: str) -> str | None:
+        """ Resolves a claimed url, failed requests are not cached so the
+        next retry tries again """
+        restored = None
+        resolved = False
+        try:
+            restored = ytmusic_restore_link(url)
+            resolved = True
+        except Exception as e:
+            logging.debug(f"Restoring {url} failed: {type(e).__name__} - {e}")
+        finally:
+            with self.lock:
+                if resolved:
+                    self.entries[url] = (restored, time.time())
+                    try:
+                        self._save()
+                    except OSError as e:
+                        logging.warning(f"Could not save restored links: {e}")
+                self.in_flight.pop(url).set()
+        return restored
+
+    def prefetch(self, urls: list[str]) -> None:
+        for url in urls:
+            if self.cached(url)[0] or self._claim(url) is not None:
+                continue
+            with self.lock:
+                if self.pool is None:
+                    self.pool = WorkerPool(self._resolve, self.workers, name="restore")
+            self.pool.submit(url)
+
+    def restore(self, url: str) -> str | None:
+        found, restored = self.cached(url)
+        if found:
+            return restored
+        event = self._claim(url)
+        if event is None:
+            return self._resolve(url)
+        event.wait()
+        return self.cached(url)[1]
@@ -0,0 +1,105 @@
+## shared http connection pools for requests made outside of yt-dlp
+## requests is imported on first use, it is a large part of the startup time
+import cfg
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+
+if TYPE_CHECKING:
+    import requests
+
+
+_adapter = None
+_local = threading.local()
+_lock = threading.Lock()
+_requests = Counter()
+_connects = Counter()
+
+
+def _count(counter: Counter, host: str) -> None:
+    with _lock:
+        counter[host] += 1
+
+
+def make_adapter_class() -> type:
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class CountingHTTPConnection(HTTPConnection):
+        def connect(self):
+            _count(_connects, self.host)
+            super().connect()
+
+    class CountingHTTPSConnection(HTTPSConnection):
+        def connect(self):
+            _count(_connects, self.host)
+            super().connect()
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = CountingHTTPConnection
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = CountingHTTPSConnection
+
+    class PooledAdapter(HTTPAdapter):
+        """ Keep-alive pools keeping up to cfg.HTTP_CONNECTIONS_PER_HOST idle
+        connections per host, new connections are counted to tell pool hits
+        from misses. Pools do not block when they are all in use, a leaked
+        response must not stall every later request to its host """
+
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': CountingHTTPConnectionPool,
+                'https': CountingHTTPSConnectionPool,
+            }
+
+    return PooledAdapter
+
+
+def get_adapter() -> "requests.adapters.HTTPAdapter":
+    """ One adapter shared by every thread, so connections to the same
+    host are reused across workers """
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            _adapter = make_adapter_class()(
+                pool_connections=cfg.HTTP_POOL_HOSTS,
+                pool_maxsize=cfg.HTTP_CONNECTIONS_PER_HOST,
+            )
+        return _adapter
+
+
+def get_session() -> "requests.Session":
+    """ Session of the current thread, sessions are not shared between
+    threads but their connection pools are """
+    session = getattr(_local, "session", None)
+    if session is None:
+        import requests
+        session = requests.Session()
+        session.mount("https://", get_adapter())
+        session.mount("http://", get_adapter())
+        _local.session = session
+    return session
+
+
+def get(url: str, **kwargs) -> "requests.Response":
+    kwargs.setdefault("timeout", cfg.HTTP_TIMEOUT)
+    _count(_requests, urlsplit(url).hostname)
+    return get_session().get(url, **kwargs)
+
+
+def stats() -> dict:
+    """ Per host counts, a request that did not open a new connection
+    was served from the pool """
+    with _lock:
+        return {
+            host: {
+                'requests': count,
+                'hits': max(0, count - _connects[host]),
+                'misses': _connects[host],
+            }
+            for host, count in _requests.items()
+        }
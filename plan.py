@@ -0,0 +1,42 @@
+## cost estimates of items before they are downloaded, for longest-first scheduling
+import cfg
+import heapq
+from dataclasses import dataclass
+
+
+@dataclass
+class Estimate:
+    bytes: int
+    seconds: float  # on one worker
+    known: bool  # from a duration or size, not the defaults
+
+
+def estimate(item: dict, info: dict = None, worker_speed: float = cfg.PLAN_WORKER_SPEED) -> Estimate:
+    """ info is the cached extract_info of the item, without it the flat
+    playlist fields kept in the item are used """
+    info = info or {}
+    size = info.get('filesize') or info.get('filesize_approx') or item.get('filesize')
+    duration = info.get('duration') or item.get('duration')
+    known = bool(size or duration)
+    if not size:
+        rate = cfg.PLAN_AUDIO_BYTERATE if item['type'] == 'audio' else cfg.PLAN_VIDEO_BYTERATE
+        size = (duration or cfg.PLAN_DEFAULT_DURATION) * rate
+    return Estimate(int(size), cfg.PLAN_ITEM_OVERHEAD + size / worker_speed, known)
+
+
+def makespan(costs: list[float], workers: int) -> float:
+    """ Time until the last of costs finishes when every one goes to the
+    first free worker in the given order. Sorted longest first this is the
+    LPT schedule, at most 4/3 of the optimum """
+    loads = [0.0] * max(1, workers)
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    return f"{minutes}m {seconds:02d}s"
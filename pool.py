@@ -0,0 +1,202 @@
+## bounded worker pool fed from a queue
+import time
+import heapq
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable
+
+
+@dataclass
+class Task:
+    args: tuple
+    result: Any = None
+    error: Exception | None = None
+    queued: float = 0.0
+    priority: float = 0.0
+    group: Any = None
+    started: float = 0.0
+    finished: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class WorkerPool:
+    """ Fixed number of worker threads taking tasks from a shared queue.
+    Workers sleep on a condition until a task is submitted, so a slot is
+    reused as soon as the previous task finishes.
+    With max_pending set, submit() blocks while that many tasks are queued.
+    Queued tasks are taken highest priority first, in submit order among
+    equal ones. Tasks submitted with a delay wait aside and are queued once
+    it passed.
+    limit (see throttle.AdaptiveLimit) caps running tasks below the number
+    of workers, a task is only taken once a slot is acquired.
+    With groups (see throttle.HostLimits) every task also needs a slot of
+    its group, group_of(*args) names it. Tasks of a group without a free
+    slot wait while those of other groups are taken.
+    on_done(task) is called from the worker thread after every task """
+
+    def __init__(
+        self,
+        target: Callable,
+        workers: int,
+        on_done: Callable = None,
+        name: str = "worker",
+        max_pending: int = 0,
+        limit=None,
+        groups=None,
+        group_of: Callable = None,
+    ):
+        self.target = target
+        self.on_done = on_done
+        self.max_pending = max_pending
+        self.limit = limit
+        self.groups = groups
+        self.group_of = group_of
+        self.pending = {}  # group -> heap of (-priority, sequence, task)
+        self.queued = 0
+        self.delayed = []  # heap of (ready time, sequence, task)
+        self.sequence = 0
+        self.closed = False
+        self.cancelled = False
+        self.cond = threading.Condition()
+        if self.limit is not None:
+            self.limit.subscribe(self.cond)
+        if self.groups is not None:
+            self.groups.subscribe(self.cond)
+        self.threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, *args, delay: float = 0, priority: float = 0) -> Task:
+        task = Task(args, queued=time.time() + max(0, delay), priority=priority)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("Pool is closed")
+            if delay > 0:
+                # retries are submitted from workers, they must not block
+                heapq.heappush(self.delayed, (task.queued, self.sequence, task))
+                self.sequence += 1
+            else:
+                while self.max_pending and self.queued >= self.max_pending:
+                    self.cond.wait()
+                self._queue(task)
+            self.cond.notify_all()
+        return task
+
+    def _queue(self, task: Task) -> None:
+        if self.group_of is not None:
+            task.group = self.group_of(*task.args)
+        heapq.heappush(self.pending.setdefault(task.group, []), (-task.priority, self.sequence, task))
+        self.sequence += 1
+        self.queued += 1
+
+    def _slot(self, group):
+        if self.groups is None or group is None:
+            return None
+        return self.groups.get(group)
+
+    def _take(self) -> tuple[Task | None, float | None]:
+        """ Best queued task that can start now, else seconds until one of
+        the groups may start again (None to wait for a release) """
+        if not self.queued or (self.limit is not None and not self.limit.available()):
+            return None, None
+        wait = None
+        heads = sorted((heap[0], group) for group, heap in self.pending.items() if heap)
+        for entry, group in heads:
+            slot = self._slot(group)
+            if slot is not None and not slot.try_acquire():
+                delay = slot.wait_time()
+                if delay and (wait is None or delay < wait):
+                    wait = delay
+                continue
+            if self.limit is not None and not self.limit.try_acquire():
+                if slot is not None:
+                    slot.revert()
+                return None, None
+            heapq.heappop(self.pending[group])
+            self.queued -= 1
+            return entry[2], None
+        return None, wait
+
+    def _promote(self) -> float | None:
+        """ Queues delayed tasks that are due, returns seconds until the next one """
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            self._queue(heapq.heappop(self.delayed)[2])
+        if self.delayed:
+            return self.delayed[0][0] - now
+        return None
+
+    def _next(self) -> Task | None:
+        with self.cond:
+            while True:
+                timeout = self._promote()
+                task, wait = self._take()
+                if task is not None:
+                    break
+                if self.closed and not self.queued and not self.delayed:
+                    return None
+                if wait is not None and (timeout is None or wait < timeout):
+                    timeout = wait
+                self.cond.wait(timeout)
+            if self.max_pending:
+                self.cond.notify_all()
+            return task
+
+    def _work(self) -> None:
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            task.started = time.time()
+            try:
+                task.result = self.target(*task.args)
+            except Exception as e:
+                task.error = e
+                logging.error(f"{type(e)} - {e}")
+            task.finished = time.time()
+            slot = self._slot(task.group)
+            if slot is not None:
+                slot.release()
+            if self.limit is not None:
+                self.limit.release()
+            if self.on_done:
+                try:
+                    self.on_done(task)
+                except Exception as e:
+                    logging.error(f"Completion callback failed: {type(e)} - {e}")
+
+    def cancel(self) -> None:
+        """ Drop queued tasks, running ones are not waited for """
+        with self.cond:
+            self.cancelled = True
+            self.closed = True
+            self.pending.clear()
+            self.queued = 0
+            self.delayed.clear()
+            self.cond.notify_all()
+
+    def close(self) -> None:
+        """ Let workers drain the queue and stop """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if not self.cancelled:
+            for thread in self.threads:
+                thread.join()
+        if self.limit is not None:
+            self.limit.unsubscribe(self.cond)
+        if self.groups is not None:
+            self.groups.unsubscribe(self.cond)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,85 @@
+## classification of failed attempts and retry delays
+import cfg
+import random
+import subprocess
+
+
+# checked first, these also come with "expected" yt-dlp errors
+TRANSIENT_MESSAGES = (
+    "http error 5",
+    "http error 429",
+    "too many requests",
+    "http error 403",  # expired signed format urls
+    "timed out",
+    "timeout",
+    "connection reset",
+    "connection aborted",
+    "connection refused",
+    "remote end closed",
+    "temporary failure in name resolution",
+    "network is unreachable",
+    "incompleteread",
+    "incomplete read",
+    "unable to download webpage",
+    "unable to download api page",
+    "confirm you're not a bot",
+    "confirm you’re not a bot",
+)
+PERMANENT_MESSAGES = (
+    "private video",
+    "video unavailable",
+    "this video is not available",
+    "this video has been removed",
+    "account associated with this video has been terminated",
+    "copyright",
+    "not available in your country",
+    "geo restrict",
+    "confirm your age",
+    "members-only",
+    "join this channel",
+    "requires payment",
+    "this live event will begin",
+    "premieres in",
+    "unsupported url",
+    "is not a valid url",
+    "requested format is not available",
+)
+PERMANENT_ERRORS = {"GeoRestrictedError", "UnsupportedError", "UnavailableVideoError"}
+
+
+def unwrap_error(e: Exception) -> Exception:
+    """ yt-dlp reports extractor and download errors wrapped in DownloadError """
+    while type(e).__name__ == "DownloadError" and getattr(e, "exc_info", None):
+        inner = e.exc_info[1]
+        if inner is None or inner is e:
+            break
+        e = inner
+    return e
+
+
+def is_transient(e: Exception) -> bool:
+    """ Whether another attempt may succeed. Unknown errors count as
+    transient, the number of attempts is bounded anyway """
+    e = unwrap_error(e)
+    message = str(e).lower()
+    if any(x in message for x in TRANSIENT_MESSAGES):
+        return True
+    if any(x in message for x in PERMANENT_MESSAGES):
+        return False
+    if PERMANENT_ERRORS & {c.__name__ for c in type(e).__mro__}:
+        return False
+    if getattr(e, "expected", False):
+        # yt-dlp marks errors explained to the user (removed, private...) as expected
+        return False
+    if isinstance(e, subprocess.CalledProcessError):
+        return False
+    if isinstance(e, (FileNotFoundError, PermissionError, IsADirectoryError)):
+        return False
+    return True
+
+
+def backoff_delay(attempt: int) -> float:
+    """ Seconds before the attempt after the given one: exponential with
+    jitter, so failures of one moment do not come back at the same time """
+    delay = min(cfg.RETRY_BACKOFF_MAX, cfg.RETRY_BACKOFF * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
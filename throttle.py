@@ -0,0 +1,283 @@
+## shared bandwidth cap and adaptive download concurrency
+import cfg
+import time
+import logging
+import threading
+from collections import deque
+from typing import Iterable
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """ Global byte budget of rate bytes per second for all workers.
+    consume() lets the bucket go into debt and sleeps the caller until the
+    debt is paid, so a worker is slowed down proportionally to its usage """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        if self.rate <= 0 or amount <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            debt = -self.tokens
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+
+class RateMeter:
+    """ Bytes per second over the last window seconds """
+
+    def __init__(self, window: float = 5):
+        self.window = window
+        self.samples = deque()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def add(self, amount: int) -> None:
+        now = time.monotonic()
+        with self.lock:
+            self.samples.append((now, amount))
+            self.total += amount
+            self._trim(now)
+
+    def _trim(self, now: float) -> None:
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.total -= self.samples.popleft()[1]
+
+    def rate(self) -> float:
+        with self.lock:
+            self._trim(time.monotonic())
+            return self.total / self.window
+
+
+class AdaptiveLimit:
+    """ Number of downloads allowed to run at once.
+    Halved on throttling, raised by one after unthrottled successes (AIMD).
+    Pools waiting for a slot subscribe their condition to be woken up """
+
+    def __init__(self, maximum: int, minimum: int = 1, cooldown: float = 10, name: str = "downloads"):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.cooldown = cooldown
+        self.limit = self.maximum
+        self.active = 0
+        self.last_decrease = 0.0
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, cond: threading.Condition) -> None:
+        with self.lock:
+            self.listeners.append(cond)
+
+    def unsubscribe(self, cond: threading.Condition) -> None:
+        with self.lock:
+            if cond in self.listeners:
+                self.listeners.remove(cond)
+
+    def _notify(self) -> None:
+        with self.lock:
+            listeners = list(self.listeners)
+        for cond in listeners:
+            with cond:
+                cond.notify_all()
+
+    def available(self) -> bool:
+        with self.lock:
+            return self.active < self.limit
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self) -> None:
+        with self.lock:
+            self.active -= 1
+        self._notify()
+
+    def decrease(self, reason: str = "") -> None:
+        with self.lock:
+            now = time.monotonic()
+            # one throttling event is usually reported by several workers
+            if now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+            old, self.limit = self.limit, max(self.minimum, self.limit // 2)
+        if old != self.limit:
+            logging.info(f"Throttled ({reason}), parallel {self.name} {old} -> {self.limit}")
+
+    def increase(self) -> None:
+        with self.lock:
+            if self.limit >= self.maximum or time.monotonic() - self.last_decrease < self.cooldown:
+                return
+            self.limit += 1
+            limit = self.limit
+        logging.debug(f"Parallel {self.name} raised to {limit}")
+        self._notify()
+
+
+class HostLimit(AdaptiveLimit):
+    """ Slots of one host, adapted to its own throttling. Downloads are
+    also started at least spacing seconds apart """
+
+    def __init__(self, host: str, maximum: int, spacing: float = 0):
+        super().__init__(maximum, cfg.MIN_WORKERS, cfg.ADAPTIVE_COOLDOWN, f"downloads from {host}")
+        self.spacing = spacing
+        self.last_start = 0.0
+        self.previous_start = 0.0
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            if self.active >= self.limit or now - self.last_start < self.spacing:
+                return False
+            self.active += 1
+            self.previous_start, self.last_start = self.last_start, now
+            return True
+
+    def revert(self) -> None:
+        """ Undoes try_acquire for a download that could not start after all """
+        with self.lock:
+            self.active -= 1
+            self.last_start = self.previous_start
+
+    def wait_time(self) -> float:
+        """ Seconds until the spacing allows the next start, 0 while all
+        slots are taken (release() wakes the waiting pools) """
+        with self.lock:
+            if self.active >= self.limit:
+                return 0
+            return max(0.0, self.spacing - (time.monotonic() - self.last_start))
+
+
+def host_key(url: str, hosts: Iterable[str] = ()) -> str:
+    """ The most specific of hosts the url belongs to, otherwise its host name """
+    host = (urlparse(url).hostname or "").lower().removeprefix("www.").removeprefix("m.")
+    host = cfg.HOST_ALIASES.get(host, host)
+    for known in sorted(hosts, key=len, reverse=True):
+        if host == known or host.endswith(f".{known}"):
+            return known
+    return host
+
+
+class HostLimits:
+    """ HostLimit per host, made on first use from limits
+    {host: (parallel downloads, seconds between starts)}, capped by default
+    (the number of workers). None parallel downloads and other hosts get
+    default, the latter without spacing. Pools subscribed here are
+    subscribed to every host """
+
+    def __init__(self, limits: dict, default: int):
+        self.limits = limits
+        self.default = default
+        self.hosts = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def key(self, url: str) -> str:
+        return host_key(url, self.limits)
+
+    def get(self, host: str) -> HostLimit:
+        with self.lock:
+            if host not in self.hosts:
+                parallel, spacing = self.limits.get(host, (None, 0))
+                limit = HostLimit(host, min(parallel or self.default, self.default), spacing)
+                for cond in self.listeners:
+                    limit.subscribe(cond)
+                self.hosts[host] = limit
+            return self.hosts[host]
+
+    def subscribe(self, cond: threading.Condition) -> None:
+        with self.lock:
+            self.listeners.append(cond)
+            for limit in self.hosts.values():
+                limit.subscribe(cond)
+
+    def unsubscribe(self, cond: threading.Condition) -> None:
+        with self.lock:
+            if cond in self.listeners:
+                self.listeners.remove(cond)
+            for limit in self.hosts.values():
+                limit.unsubscribe(cond)
+
+    def stats(self) -> dict:
+        with self.lock:
+            hosts = dict(self.hosts)
+        return {host: {'active': limit.active, 'limit': limit.limit} for host, limit in hosts.items()}
+
+
+class Throttle:
+    """ Bandwidth cap and concurrency limit shared by all download workers,
+    fed from yt-dlp progress hooks. Per host slots (cfg.HOST_LIMITS updated
+    with host_limits) are adapted to the throttling reported for that host.
+    postprocess_limit caps ffmpeg runs of every pool using it, it is not
+    adapted """
+
+    def __init__(self, rate: int, workers: int, postprocess_workers: int = None, host_limits: dict = None):
+        self.rate = rate
+        self.bucket = TokenBucket(rate)
+        self.meter = RateMeter()
+        self.limit = AdaptiveLimit(workers, cfg.MIN_WORKERS, cfg.ADAPTIVE_COOLDOWN)
+        self.hosts = HostLimits({**cfg.HOST_LIMITS, **(host_limits or {})}, workers)
+        self.postprocess_limit = AdaptiveLimit(postprocess_workers or workers)
+
+    def on_bytes(self, amount: int) -> None:
+        self.meter.add(amount)
+        self.bucket.consume(amount)
+
+    def saturated(self) -> bool:
+        return self.rate > 0 and self.meter.rate() >= self.rate * 0.9
+
+    def is_slow(self, speed: float) -> bool:
+        """ Speed of one download is below the throttling threshold and
+        not because of our own bandwidth cap """
+        if self.rate > 0 and self.rate / max(1, self.limit.active) < cfg.THROTTLED_SPEED:
+            return False
+        return speed < cfg.THROTTLED_SPEED
+
+    def on_success(self, host: str = None) -> None:
+        if not self.saturated():
+            (self.hosts.get(host) if host else self.limit).increase()
+
+    def on_throttled(self, reason: str, host: str = None) -> None:
+        """ Throttling of one host only lowers the downloads from it """
+        (self.hosts.get(host) if host else self.limit).decrease(reason)
+
+
+def is_throttle_error(e: Exception) -> bool:
+    message = str(e)
+    return "HTTP Error 429" in message or "Too Many Requests" in message
+
+
+def parse_host_limits(value: str) -> dict:
+    """ "instagram.com=2:3,youtube.com=6" into {host: (parallel, spacing)} """
+    limits = {}
+    for part in value.split(","):
+        if not part.strip():
+            continue
+        host, limit = part.split("=", 1)
+        parallel, _, spacing = limit.partition(":")
+        limits[host.strip().lower()] = (max(1, int(parallel)), max(0.0, float(spacing or 0)))
+    return limits
+
+
+def parse_rate(value: str) -> int:
+    """ "500K", "2.5M", "1G" or plain bytes per second """
+    value = value.strip().upper().removesuffix("/S").removesuffix("B")
+    multiplier = 1
+    if value and value[-1] in "KMG":
+        multiplier = 1024 ** ("KMG".index(value[-1]) + 1)
+        value = value[:-1]
+    return int(float(value) * multiplier)
@@ -0,0 +1,74 @@
+## reusable YoutubeDL instances
+import threading
+from contextlib import contextmanager
+
+
+def close_instance(instance) -> None:
+    try:
+        instance.__exit__(None, None, None)
+    except Exception:
+        pass
+
+
+class YoutubeDLPool:
+    """ Idle instances by profile key, each one is used by a single worker
+    at a time. Builds keep extractors, http handlers and cookies warm, so
+    per item settings are changed on a checked out instance instead of
+    building a new one. Instances built for another generation (of the
+    cookies) and ones that raised are closed instead of being reused """
+
+    def __init__(self, max_idle: int):
+        self.max_idle = max_idle
+        self.idle = {}  # key -> list of (instance, generation)
+        self.created = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self, key, build, generation: int = 0):
+        """ build() makes a new instance when no idle one fits """
+        instance = None
+        stale = []
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle and instance is None:
+                candidate, candidate_generation = idle.pop()
+                if candidate_generation == generation:
+                    instance = candidate
+                    self.reused += 1
+                else:
+                    stale.append(candidate)
+        for candidate in stale:
+            close_instance(candidate)
+        if instance is None:
+            instance = build()
+            with self.lock:
+                self.created += 1
+        try:
+            yield instance
+        except BaseException:
+            close_instance(instance)
+            raise
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((instance, generation))
+                return
+        close_instance(instance)
+
+    def reserve(self, workers: int) -> None:
+        """ Keeps up to workers idle instances per key, the largest number
+        of workers asked for so far """
+        with self.lock:
+            self.max_idle = max(self.max_idle, workers)
+
+    def clear(self) -> None:
+        with self.lock:
+            instances = [i for idle in self.idle.values() for i, _ in idle]
+            self.idle.clear()
+        for instance in instances:
+            close_instance(instance)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'created': self.created, 'reused': self.reused}
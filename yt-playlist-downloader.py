@@ -1,12 +1,17 @@
+import time
+started = time.perf_counter()
 import os
 import cfg
 import sys
+import net
 import json
-import time
 import logging
-import requests
+import importlib
+import threading
 import subprocess
-from main import Context, main
+from main import Context, main, ydl_pool
+from throttle import parse_rate, parse_host_limits
+imported = time.perf_counter()
 
 
 def check_ffmpeg():
@@ -37,6 +42,9 @@ def parse_args(context: Context):
     context.launch_checks = not any(x in sys.argv for x in ("-nc", "--no-checks", "--nocheks", "--nochek", "--nochecks"))
     if not context.launch_checks:
         context.launch_checks = saved_settings.get("launch_checks", context.launch_checks)
+    context.use_archive = not any(x in sys.argv for x in ("-na", "--no-archive", "--noarchive"))
+    if context.use_archive:
+        context.use_archive = saved_settings.get("use_archive", context.use_archive)
     context.output = cfg.DEFAULT_OUTPUT_DIR
     context.output = saved_settings.get("output_dir", context.output)
     arg = [x for x in ("-o", "--output", "--output-dir", "--outputdir") if x in sys.argv]
@@ -59,17 +67,109 @@ def parse_args(context: Context):
                 context.cookies = sys.argv[cookies_index + 1]
         except:
             pass
+    context.workers = cfg.MAX_THREADS
+    context.workers = saved_settings.get("workers", context.workers)
+    arg = [x for x in ("-w", "--workers") if x in sys.argv]
+    if arg:
+        arg = arg[0]
+        try:
+            workers_index = sys.argv.index(arg)
+            if workers_index < len(sys.argv) - 1:
+                context.workers = max(1, int(sys.argv[workers_index + 1]))
+        except:
+            pass
+    context.metadata_ttl = cfg.METADATA_CACHE_TTL
+    context.metadata_ttl = saved_settings.get("metadata_ttl", context.metadata_ttl)
+    arg = [x for x in ("-mt", "--metadata-ttl") if x in sys.argv]
+    if arg:
+        arg = arg[0]
+        try:
+            ttl_index = sys.argv.index(arg)
+            if ttl_index < len(sys.argv) - 1:
+                context.metadata_ttl = max(0, int(sys.argv[ttl_index + 1]))
+        except:
+            pass
+    context.rate_limit = 0
+    context.rate_limit = saved_settings.get("rate_limit", context.rate_limit)
+    arg = [x for x in ("-lr", "--limit-rate", "--limitrate") if x in sys.argv]
+    if arg:
+        arg = arg[0]
+        try:
+            rate_index = sys.argv.index(arg)
+            if rate_index < len(sys.argv) - 1:
+                context.rate_limit = max(0, parse_rate(sys.argv[rate_index + 1]))
+        except:
+            pass
+    context.host_limits = {}
+    context.host_limits = saved_settings.get("host_limits", context.host_limits)
+    arg = [x for x in ("-hl", "--host-limit", "--hostlimit") if x in sys.argv]
+    if arg:
+        arg = arg[0]
+        try:
+            limits_index = sys.argv.index(arg)
+            if limits_index < len(sys.argv) - 1:
+                context.host_limits = parse_host_limits(sys.argv[limits_index + 1])
+        except:
+            print("Host limits must look like instagram.com=2:3,youtube.com=6")
+    context.audio_profile = cfg.DEFAULT_AUDIO_PROFILE
+    context.audio_profile = saved_settings.get("audio_profile", context.audio_profile)
+    arg = [x for x in ("-ap", "--audio-profile", "--audioprofile") if x in sys.argv]
+    if arg:
+        arg = arg[0]
+        try:
+            profile_index = sys.argv.index(arg)
+            if profile_index < len(sys.argv) - 1:
+                profile = sys.argv[profile_index + 1].lower()
+                if profile not in cfg.AUDIO_PROFILES:
+                    raise ValueError(f"Unknown audio profile {profile}")
+                context.audio_profile = profile
+        except:
+            print(f"Audio profile must be one of {', '.join(cfg.AUDIO_PROFILES)}")
+    context.plan_only = any(x in sys.argv for x in ("-p", "--plan"))
+    context.dump_info = any(x in sys.argv for x in ("-di", "--dump-info", "--dumpinfo"))
+    if not context.dump_info:
+        context.dump_info = saved_settings.get("dump_info", context.dump_info)
     if any(x in sys.argv for x in ("-sv", "--save-settings", "--savesettings")):
         saved_settings = {
             "single_input": context.single_input,
             "launch_checks": context.launch_checks,
             "output_dir": context.output,
             "cookies": context.cookies,
+            "use_archive": context.use_archive,
+            "workers": context.workers,
+            "metadata_ttl": context.metadata_ttl,
+            "rate_limit": context.rate_limit,
+            "host_limits": context.host_limits,
+            "audio_profile": context.audio_profile,
+            "dump_info": context.dump_info,
         }
         with open(cfg.SETTINGS_FILE, "w", encoding="utf-8") as f:
             json.dump(saved_settings, f, indent=2)
 
-def version_check() -> tuple[bool, str, str]:
+def fetch_latest_version(use_cache: bool = True) -> str:
+    """ Contents of the latest .version, kept for cfg.VERSION_CHECK_TTL seconds """
+    if use_cache:
+        try:
+            with open(cfg.VERSION_CACHE_FILE, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if time.time() - cached["time"] < cfg.VERSION_CHECK_TTL:
+                return cached["latest"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    url = cfg.GIT_LINK.strip('/').replace("://github.com/", "://raw.githubusercontent.com/")
+    url += "/refs/heads/main/.version"
+    resp = net.get(url, timeout=5)
+    if resp.status_code // 100 not in [2, 3]:
+        raise ValueError()
+    try:
+        os.makedirs(os.path.dirname(cfg.VERSION_CACHE_FILE), exist_ok=True)
+        with open(cfg.VERSION_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump({"time": time.time(), "latest": resp.text}, f)
+    except OSError:
+        pass
+    return resp.text
+
+def version_check(out=print, use_cache: bool = True) -> tuple[bool, str, str]:
     current = ""
     try:
         with open(".version", "r") as f:
@@ -87,24 +187,19 @@ def version_check() -> tuple[bool, str, str]:
     if not current:
         current = [-1]
     
-    print(f"  v{'.'.join([str(v) for v in current])}")
-    print()
+    out(f"  v{'.'.join([str(v) for v in current])}")
+    out()
     
     latest = ""
     try:
-        url = cfg.GIT_LINK.strip('/').replace("://github.com/", "://raw.githubusercontent.com/")
-        url += "/refs/heads/main/.version"
-        resp = requests.get(url, timeout=5)
-        if resp.status_code // 100 not in [2, 3]:
-            raise ValueError()
-        text = resp.text
+        text = fetch_latest_version(use_cache)
         for l in text:
             if l in ".0123456789":
                 latest += l
     except:
-        print("  !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        print("    FAILED TO FETCH LATEST VERSION  ")
-        print("  !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        out("  !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        out("    FAILED TO FETCH LATEST VERSION  ")
+        out("  !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         if current == [-1]:
             current = None
         else:
@@ -117,9 +212,9 @@ def version_check() -> tuple[bool, str, str]:
     except:
         latest = []
     if not latest:
-        print("  !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        print("    FAILED TO FETCH LATEST VERSION  ")
-        print("  !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        out("  !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        out("    FAILED TO FETCH LATEST VERSION  ")
+        out("  !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         if current == [-1]:
             current = None
         else:
@@ -131,12 +226,12 @@ def version_check() -> tuple[bool, str, str]:
         l = latest[i]  if i < len(latest)  else 0
         
         if l > c:
-            print("  !!!!!!!!!!!!!!!!!!!!!")
-            print("    NEW VERSION FOUND  ")
-            print("  !!!!!!!!!!!!!!!!!!!!!")
-            print(f"Found better version v{'.'.join(map(str, latest))}")
-            print(f"Update via update script or here: {cfg.GIT_LINK}")
-            print()
+            out("  !!!!!!!!!!!!!!!!!!!!!")
+            out("    NEW VERSION FOUND  ")
+            out("  !!!!!!!!!!!!!!!!!!!!!")
+            out(f"Found better version v{'.'.join(map(str, latest))}")
+            out(f"Update via update script or here: {cfg.GIT_LINK}")
+            out()
             if current == [-1]:
                 current = None
             else:
@@ -144,10 +239,10 @@ def version_check() -> tuple[bool, str, str]:
             latest = f"v{'.'.join([str(v) for v in latest])}"
             return True, current, latest
         elif l < c:
-            print(f"Program version is newer (local v{'.'.join(map(str, current))} > latest v{'.'.join(map(str, latest))})")
+            out(f"Program version is newer (local v{'.'.join(map(str, current))} > latest v{'.'.join(map(str, latest))})")
             break
     else:
-        print(f"Program is up to date (v{'.'.join(map(str, latest))})")
+        out(f"Program is up to date (v{'.'.join(map(str, latest))})")
     if current == [-1]:
         current = None
     else:
@@ -155,16 +250,15 @@ def version_check() -> tuple[bool, str, str]:
     latest = f"v{'.'.join([str(v) for v in latest])}"
     return False, current, latest
 
-def connection_check():
-    import requests
-    print("Checking connection...", end=" ")
+def connection_check(out=print):
+    out("Checking connection...", end=" ")
     try:
-        res = requests.get("https://www.youtube.com", timeout=5)
+        res = net.get("https://www.youtube.com", timeout=5)
         res.raise_for_status()
-        print("OK")
+        out("OK")
     except Exception as e:
-        print("BAD")
-        print(cfg.BAD_CONNECTION_MESSAGE)
+        out("BAD")
+        out(cfg.BAD_CONNECTION_MESSAGE)
 
 def cookies_check(context: Context) -> int:
     """ Returns:
@@ -182,19 +276,111 @@ def cookies_check(context: Context) -> int:
     return 1
 
 
-def cli(context: Context = None):
+class LaunchChecks:
+    """ Version and connection checks running in the background while the
+    prompt is shown. Their output is kept and printed by report() """
+
+    def __init__(self):
+        self.lines = {"version": [], "connection": []}
+        self.durations = {}
+        self.reported = set()
+        self.threads = {
+            name: threading.Thread(target=self._check, args=(name, func), daemon=True)
+            for name, func in (("version", version_check), ("connection", connection_check))
+        }
+        for thread in self.threads.values():
+            thread.start()
+        # the first download would wait for yt_dlp otherwise
+        threading.Thread(target=self._preload, daemon=True).start()
+
+    def _check(self, name: str, func) -> None:
+        def out(*args, end="\n"):
+            self.lines[name].append(" ".join(str(a) for a in args) + end)
+        check_started = time.perf_counter()
+        try:
+            func(out=out)
+        except Exception as e:
+            out(f"{name.capitalize()} check failed: {e}")
+        self.durations[name] = time.perf_counter() - check_started
+
+    def _preload(self) -> None:
+        for thread in self.threads.values():
+            thread.join()
+        importlib.import_module("yt_dlp")
+
+    def report(self, timeout: float = None, profile: bool = False) -> bool:
+        """ Prints finished checks in order, waits up to timeout seconds for
+        them. Returns False if some are still running """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for name, thread in self.threads.items():
+            if name in self.reported:
+                continue
+            thread.join(None if deadline is None else max(0, deadline - time.perf_counter()))
+            if thread.is_alive():
+                return False
+            print("".join(self.lines[name]), end="")
+            if profile:
+                print(f"[startup] {name} check took {self.durations[name]:.3f}s")
+            self.reported.add(name)
+        return True
+
+
+def setup_logging() -> str:
+    os.makedirs("logs", exist_ok=True)
+    log_file = f"logs/log_{int(time.time()*1000)}.txt"
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="[%(asctime)s] %(levelname)s - %(message)s",
+        handlers=[
+            logging.StreamHandler(sys.stdout),
+            logging.FileHandler(log_file, encoding="utf-8"),
+        ],
+    )
+    return log_file
+
+
+def run_daemon(context: Context):
+    import daemon
+    port = cfg.DAEMON_PORT
+    arg = [x for x in ("-d", "--daemon") if x in sys.argv][0]
+    try:
+        port_index = sys.argv.index(arg)
+        if port_index < len(sys.argv) - 1:
+            port = int(sys.argv[port_index + 1])
+    except:
+        pass
+    print(cfg.LOGO)
+    cookies_check(context)
+    log_file = setup_logging()
+    try:
+        daemon.serve(context, port)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Logs were saved to {log_file}")
+
+
+def cli(context: Context = None, profile_startup: bool = False):
     if context is None:
         context = Context()
 
     print(cfg.LOGO)
 
+    checks = None
     if context.launch_checks:
-        version_check()
-        connection_check()
+        checks = LaunchChecks()
+        # cached and fast checks are printed before the prompt, slow ones after the input
+        if checks.report(cfg.LAUNCH_CHECKS_WAIT, profile_startup):
+            checks = None
         cookies_check(context)
         print()
     print(f"Output directory: {os.path.abspath(context.output)}")
     print("Type help for more information")
+    if profile_startup:
+        print(
+            f"[startup] imports {imported - started:.3f}s, "
+            f"prompt after {time.perf_counter() - started:.3f}s"
+        )
     inp = ""
     try:
         while not inp:
@@ -203,16 +389,9 @@ def cli(context: Context = None):
                 break
     except:
         sys.exit(1)
-    os.makedirs("logs", exist_ok=True)
-    log_file = f"logs/log_{int(time.time()*1000)}.txt"
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format="[%(asctime)s] %(levelname)s - %(message)s",
-        handlers=[
-            logging.StreamHandler(sys.stdout),
-            logging.FileHandler(log_file, encoding="utf-8"),
-        ],
-    )
+    if checks is not None:
+        checks.report(profile=profile_startup)
+    log_file = setup_logging()
     try:
         while True:
             main(inp, context)
@@ -225,6 +404,7 @@ def cli(context: Context = None):
             except:
                 sys.exit(1)
     finally:
+        ydl_pool.clear()
         print(f"Logs were saved to {log_file}")
 
 
@@ -235,7 +415,11 @@ def launch():
     
     context = Context()
     parse_args(context)
-    cli(context)
+    if any(x in sys.argv for x in ("-d", "--daemon")):
+        run_daemon(context)
+        return
+    profile_startup = any(x in sys.argv for x in ("-ps", "--profile-startup", "--profilestartup"))
+    cli(context, profile_startup)
 
 
 if __name__ == "__main__":